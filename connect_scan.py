@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import collections
+import re
+import threading
+import ipaddress
+import socket
+import sys
+import time
+
+import scan_output
+from scanner import TargetScope
+
+# ports scanned when none are given
+PORTS = [21, 22, 23, 25, 80, 443, 8000, 8080]
+
+OPEN = 'open'
+CLOSED = 'closed'
+FILTERED = 'filtered'
+UNREACHABLE = 'unreachable'
+
+PortResult = collections.namedtuple('PortResult', ['host', 'port', 'state', 'rtt', 'service', 'banner'],
+                                    defaults=(None, None))
+
+HTTP_PROBE = b'HEAD / HTTP/1.0\r\n\r\n'
+# what to send when a service stays quiet after the connect, by port
+PROBES = {80: HTTP_PROBE, 8000: HTTP_PROBE, 8008: HTTP_PROBE, 8080: HTTP_PROBE, 8888: HTTP_PROBE}
+# what to send after a server-first greeting to learn a little more
+FOLLOW_UPS = {'smtp': b'EHLO scanner.local\r\n'}
+
+# first match wins, group 1 (when present) is reported as the version
+SIGNATURES = [(name, re.compile(pattern, re.DOTALL)) for name, pattern in [
+    ('ssh', rb'^SSH-[\d.]+-(\S+)'),
+    ('ftp', rb'^220[ -].*?\bFTP\b'),
+    ('smtp', rb'^220[ -]\S+ (E?SMTP[^\r\n]*)'),
+    ('pop3', rb'^\+OK'),
+    ('imap', rb'^\* OK'),
+    ('http', rb'^HTTP/\d\.\d \d{3}(?:.*?\r\nServer: ([^\r\n]+))?'),
+    ('mysql', rb'^.{4}\x0a([\d.]+[\w.-]*)\x00'),
+]]
+
+# "21,22,80-90" -> [21, 22, 80, 81, ..., 90]
+def parse_ports(spec):
+    if isinstance(spec, int):
+        return [spec]
+    if not isinstance(spec, str):
+        return sorted(set(int(port) for port in spec))
+    ports = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            ports.update(range(int(first), int(last) + 1))
+        else:
+            ports.add(int(part))
+    if any(port < 1 or port > 65535 for port in ports):
+        raise ValueError(f'port out of range in {spec!r}')
+    return sorted(ports)
+
+def parse_hosts(spec):
+    if isinstance(spec, str):
+        spec = spec.split(',')
+    hosts = []
+    for target in spec:
+        network = ipaddress.IPv4Network(target, strict=False)
+        if network.num_addresses == 1:
+            hosts.append(str(network.network_address))
+        else:
+            hosts.extend(str(ipaddress.IPv4Address(addr)) for addr in TargetScope([target]).addresses())
+    return hosts
+
+# per-host connect timeout derived from observed handshake times, the same
+# smoothed RTT / RTT variance estimator TCP uses for its retransmit timer
+class AdaptiveTimeout:
+    __slots__ = ('srtt', 'rttvar', 'samples', 'initial', 'minimum', 'maximum')
+
+    # below this many samples the estimate is still shaky
+    SETTLED = 8
+
+    def __init__(self, initial=1.0, minimum=0.05, maximum=3.0):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def observe(self, rtt):
+        self.samples += 1
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial
+        return min(self.maximum, max(self.minimum, self.srtt + 4 * self.rttvar))
+
+def identify(data):
+    for name, pattern in SIGNATURES:
+        match = pattern.match(data)
+        if match:
+            version = match.group(1) if match.groups() and match.group(1) else b''
+            return name, version.decode('latin-1')
+    return None, None
+
+def banner_line(data):
+    return data.split(b'\n', 1)[0].strip().decode('latin-1')[:120]
+
+async def _recv(loop, sock, size, timeout):
+    try:
+        return await asyncio.wait_for(loop.sock_recv(sock, size), timeout)
+    except (asyncio.TimeoutError, OSError):
+        return b''
+
+# fingerprints a service over the socket the connect scan just opened: wait
+# briefly for a server-first greeting, otherwise send the port's probe,
+# then match the bounded response against the signature table
+async def grab_banner(sock, port, timeout=1.0, max_bytes=1024):
+    loop = asyncio.get_running_loop()
+    data = await _recv(loop, sock, max_bytes, timeout)
+    if not data:
+        try:
+            await loop.sock_sendall(sock, PROBES.get(port, HTTP_PROBE))
+        except OSError:
+            return None, None
+        data = await _recv(loop, sock, max_bytes, timeout)
+    service, version = identify(data)
+    if service in FOLLOW_UPS:
+        try:
+            await loop.sock_sendall(sock, FOLLOW_UPS[service])
+            data += await _recv(loop, sock, max_bytes - len(data), timeout)
+        except OSError:
+            pass
+    if not data:
+        return None, None
+    return service or 'unknown', version or banner_line(data)
+
+# the same stage for callers with a blocking socket
+def grab_banner_sync(sock, port, timeout=1.0, max_bytes=1024):
+    sock.settimeout(timeout)
+
+    def recv(size):
+        try:
+            return sock.recv(size)
+        except OSError:
+            return b''
+
+    data = recv(max_bytes)
+    if not data:
+        try:
+            sock.sendall(PROBES.get(port, HTTP_PROBE))
+        except OSError:
+            return None, None
+        data = recv(max_bytes)
+    service, version = identify(data)
+    if service in FOLLOW_UPS:
+        try:
+            sock.sendall(FOLLOW_UPS[service])
+            data += recv(max_bytes - len(data))
+        except OSError:
+            pass
+    if not data:
+        return None, None
+    return service or 'unknown', version or banner_line(data)
+
+async def connect(host, port, timeout):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, (host, port)), timeout)
+    except asyncio.TimeoutError:
+        sock.close()
+        return FILTERED, None, None
+    except ConnectionRefusedError:
+        sock.close()
+        return CLOSED, time.perf_counter() - start, None
+    except OSError:
+        sock.close()
+        return UNREACHABLE, None, None
+    return OPEN, time.perf_counter() - start, sock
+
+# connect-scans every host/port pair with at most `concurrency` connects in
+# flight overall and `per_host` against any single host, yielding a
+# PortResult as each probe finishes. with banners=True an open port is
+# fingerprinted over the same connection before the worker moves on, so
+# the banner stage shares the scan's concurrency budget
+async def scan(hosts, ports=PORTS, concurrency=500, per_host=64, timeout=1.0, min_timeout=0.1,
+               banners=False, banner_timeout=1.0, banner_bytes=1024):
+    hosts = parse_hosts(hosts) if isinstance(hosts, str) else list(hosts)
+    ports = parse_ports(ports)
+    limits = {host: asyncio.Semaphore(per_host) for host in hosts}
+    timers = {host: AdaptiveTimeout(timeout, min_timeout, max(timeout, 3.0)) for host in hosts}
+    # port-major order spreads consecutive probes across hosts so the
+    # per-host limits rarely stall a worker
+    jobs = ((host, port) for port in ports for host in hosts)
+    results = asyncio.Queue()
+    done = object()
+
+    async def worker():
+        try:
+            for host, port in jobs:
+                timer = timers[host]
+                async with limits[host]:
+                    timeout = timer.timeout
+                    state, rtt, sock = await connect(host, port, timeout)
+                    # a timeout learned from a handful of samples can be too
+                    # tight, so until the estimate settles silence is
+                    # confirmed with the initial timeout; after that a dead
+                    # port costs only the learned timeout
+                    if state == FILTERED and timeout < timer.initial and timer.samples < timer.SETTLED:
+                        state, rtt, sock = await connect(host, port, timer.initial)
+                    service = banner = None
+                    if sock is not None:
+                        if banners:
+                            service, banner = await grab_banner(sock, port, banner_timeout, banner_bytes)
+                        sock.close()
+                if rtt is not None:
+                    timer.observe(rtt)
+                await results.put(PortResult(host, port, state, rtt, service, banner))
+        finally:
+            await results.put(done)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(hosts) * len(ports))))]
+    running = len(workers)
+    try:
+        while running:
+            result = await results.get()
+            if result is done:
+                running -= 1
+            else:
+                yield result
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+# blocking helper: {host: [open ports]} for every host that has any
+def scan_ports(hosts, ports=PORTS, **kwargs):
+    async def collect():
+        found = collections.defaultdict(list)
+        async for result in scan(hosts, ports, **kwargs):
+            if result.state == OPEN:
+                found[result.host].append(result.port)
+        return {host: sorted(open_ports) for host, open_ports in found.items()}
+    return asyncio.run(collect())
+
+# opens `listeners` loopback listeners, then scans them together with
+# enough closed ports to make up `total` probes and reports the rate
+def benchmark(total=5000, listeners=200, concurrency=500):
+    servers = []
+    for _ in range(listeners):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(8)
+        servers.append(server)
+    open_ports = set(server.getsockname()[1] for server in servers)
+    ports = set(open_ports)
+    candidate = 20000
+    while len(ports) < total:
+        if candidate not in open_ports:
+            ports.add(candidate)
+        candidate += 1
+
+    async def run():
+        counts = collections.Counter()
+        async for result in scan(['127.0.0.1'], sorted(ports), concurrency, per_host=concurrency):
+            counts[result.state] += 1
+        return counts
+
+    start = time.perf_counter()
+    counts = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    for server in servers:
+        server.close()
+    print(f'[*] {len(ports)} ports in {elapsed:.2f}s: {len(ports) / elapsed:,.0f} ports/s')
+    print(f'[*] {counts[OPEN]} open (expected {listeners}), {counts[CLOSED]} closed, '
+          f'{counts[FILTERED]} filtered, {counts[UNREACHABLE]} unreachable')
+
+# stub services that behave like the real thing for the first exchange
+STUB_SERVICES = {
+    'ssh': (b'SSH-2.0-OpenSSH_9.6\r\n', None),
+    'smtp': (b'220 mail.example.com ESMTP Postfix\r\n', b'250-mail.example.com\r\n250 SIZE 10240000\r\n'),
+    'http': (None, b'HTTP/1.0 200 OK\r\nServer: nginx/1.25.3\r\nContent-Length: 0\r\n\r\n'),
+    'silent': (None, None),
+}
+
+def _serve_stub(server, greeting, reply):
+    while True:
+        try:
+            client, _ = server.accept()
+        except OSError:
+            return
+        with client:
+            client.settimeout(2)
+            try:
+                if greeting:
+                    client.sendall(greeting)
+                if reply and client.recv(1024):
+                    client.sendall(reply)
+                client.recv(1024)
+            except OSError:
+                pass
+
+# starts the stub services on loopback and fingerprints them through the
+# scanner, returning {service name: (port, detected service, banner)}
+def banner_check(timeout=0.3):
+    stubs = {}
+    for name, (greeting, reply) in STUB_SERVICES.items():
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(16)
+        threading.Thread(target=_serve_stub, args=(server, greeting, reply), daemon=True).start()
+        stubs[server.getsockname()[1]] = (name, server)
+
+    async def run():
+        found = {}
+        async for result in scan(['127.0.0.1'], sorted(stubs), banners=True, banner_timeout=timeout):
+            found[stubs[result.port][0]] = (result.port, result.service, result.banner)
+        return found
+
+    try:
+        return asyncio.run(run())
+    finally:
+        for _, server in stubs.values():
+            server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='asyncio TCP connect scanner')
+    parser.add_argument('targets', nargs='?', help='hosts or CIDRs, comma separated')
+    parser.add_argument('-p', '--ports', default=','.join(map(str, PORTS)), help='ports and ranges, e.g. 22,80,8000-8100')
+    parser.add_argument('-c', '--concurrency', type=int, default=500, help='connects in flight overall')
+    parser.add_argument('--per-host', type=int, default=64, help='connects in flight per host')
+    parser.add_argument('--timeout', type=float, default=1.0, help='initial connect timeout in seconds')
+    parser.add_argument('--all', action='store_true', help='also report closed and filtered ports')
+    parser.add_argument('-b', '--banners', action='store_true', help='fingerprint open ports over the scan connection')
+    parser.add_argument('--banner-timeout', type=float, default=1.0, help='seconds to wait for each banner read')
+    parser.add_argument('--banner-check', action='store_true', help='fingerprint local stub services and exit')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='scan N loopback ports and report ports/s')
+    scan_output.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, concurrency=args.concurrency)
+        return
+    if args.banner_check:
+        for name, (port, service, banner) in banner_check().items():
+            print(f'{name:>6} stub on {port}: {service} {banner}')
+        return
+    if not args.targets:
+        parser.error('targets are required')
+
+    sink = scan_output.sinks_from_args('connect_scan', args)
+
+    async def run():
+        async for result in scan(args.targets, args.ports, args.concurrency, args.per_host, args.timeout,
+                                 banners=args.banners, banner_timeout=args.banner_timeout):
+            if result.state == OPEN or args.all:
+                sink.emit('port', host=result.host, port=result.port, state=result.state,
+                          rtt=round(result.rtt, 6) if result.rtt is not None else None,
+                          service=result.service, banner=result.banner)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print('User interrupted.')
+        sys.exit()
+    finally:
+        sink.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,90 @@
 import argparse
+import collections
+import hashlib
+import lzma
+import os
+import queue
+import resource
+import selectors
+import signal
 import socket
 import shlex
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
 import textwrap
 import threading
+import time
+import zlib
+
+# optional upload header: magic and the file size, so the receiver can
+# preallocate and knows where the file ends
+SIZE_HEADER = struct.Struct('!4sQ')
+SIZE_MAGIC = b'NCSZ'
+CHUNK = 1024 * 1024
+STREAM_BUFFER = 256 * 1024
+PROMPT = b'BHP: #>'
+MAX_LINE = 64 * 1024
+# compression handshake: the sender offers a method, the listener answers
+# with the one it will decode, 0 for none
+OFFER = struct.Struct('!4sB')
+OFFER_MAGIC = b'NCZO'
+ACK = struct.Struct('!4sB')
+ACK_MAGIC = b'NCZA'
+METHODS = {'zlib': 1, 'lzma': 2}
+
+# listener counters, updated from every worker. accept latency is how long
+# an accepted connection waited for a free worker; with every slot taken
+# the listener stops accepting, and `stalls` counts how often that happened
+class ListenerStats:
+    def __init__(self, samples=4096):
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.finished = 0
+        self.active = 0
+        self.peak = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.stalls = 0
+        self.stalled = 0.0
+        # the most recent sessions, for percentiles
+        self.latencies = collections.deque(maxlen=samples)
+        self.durations = collections.deque(maxlen=samples)
+
+    def start(self, latency):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.latencies.append(latency)
+            return self.active
+
+    def finish(self, duration, error=None):
+        with self.lock:
+            self.active -= 1
+            self.finished += 1
+            self.durations.append(duration)
+            if isinstance(error, TimeoutError):
+                self.timeouts += 1
+            elif error is not None:
+                self.errors += 1
+
+    @staticmethod
+    def percentiles(samples):
+        if not samples:
+            return 'no samples'
+        ordered = sorted(samples)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+        return f'p50 {pick(0.5):.2f} p99 {pick(0.99):.2f} max {ordered[-1] * 1000:.2f} ms'
+
+    def __str__(self):
+        with self.lock:
+            latencies, durations = list(self.latencies), list(self.durations)
+            return (f'{self.accepted} accepted, {self.active} active (peak {self.peak}), {self.finished} finished, '
+                    f'{self.timeouts} idle timeouts, {self.errors} errors, listener stalled {self.stalls} times '
+                    f'({self.stalled:.2f}s); accept latency {self.percentiles(latencies)}; '
+                    f'session {self.percentiles(durations)}')
 
 class NetCat:
     def __init__(self, args, buffer=None):
@@ -12,6 +92,7 @@ class NetCat:
         self.buffer = buffer
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sessions = threading.BoundedSemaphore(args.max_sessions)
      
     def run(self):
         if self.args.listen:
@@ -21,6 +102,28 @@ class NetCat:
     
     def send(self):
         self.socket.connect((self.args.target, self.args.port))
+        self.compressor = None
+        if self.args.compress:
+            try:
+                self.compressor = offer_compression(self.socket, self.args.compress, self.args.level)
+            except OSError as e:
+                # not an upload listener of this version: whatever it made
+                # of the offer, there is nothing to fall back to
+                print(f'[!] compression offer failed: {e or "no answer"}', file=sys.stderr)
+                self.socket.close()
+                sys.exit(1)
+        if self.args.file:
+            start = time.perf_counter()
+            send_file(self.socket, self.args.file, self.compressor)
+            # the receiver answers with what it saved, then closes
+            print(recv_all(self.socket).decode(errors='replace'))
+            if self.compressor:
+                print(f'[*] {self.compressor.summary(time.perf_counter() - start)}', file=sys.stderr)
+            self.socket.close()
+            return
+        if self.args.stream:
+            self.stream()
+            return
         if self.buffer:
             self.socket.send(self.buffer)
         try:
@@ -43,54 +146,606 @@ class NetCat:
             self.socket.close()
             sys.exit()
         
+    # full duplex: stdin goes to the socket from a second thread while this
+    # one copies the socket to stdout, both as raw bytes through a reusable
+    # buffer of --buffer-size bytes. end of stdin half-closes the
+    # connection so the other side can still answer; the session is over
+    # once it closes
+    def stream(self):
+        sender = threading.Thread(target=self._pump_stdin, daemon=True)
+        sender.start()
+        view = memoryview(bytearray(self.args.buffer_size))
+        out = sys.stdout.fileno()
+        try:
+            while True:
+                n = self.socket.recv_into(view)
+                if not n:
+                    break
+                chunk = view[:n]
+                while len(chunk):
+                    chunk = chunk[os.write(out, chunk):]
+        except BrokenPipeError:
+            # whoever reads our stdout has gone
+            pass
+        except OSError as e:
+            print(f'[!] connection lost: {e}', file=sys.stderr)
+            sys.exit(1)
+        finally:
+            self.socket.close()
+
+    def _pump_stdin(self):
+        fd = sys.stdin.fileno()
+        compressor = self.compressor
+        start = time.perf_counter()
+        try:
+            with open(fd, 'rb', buffering=0, closefd=False) as source:
+                if stat.S_ISREG(os.fstat(fd).st_mode) and compressor is None:
+                    # a redirected file goes out straight from the page cache
+                    self.socket.sendfile(source)
+                else:
+                    view = memoryview(bytearray(self.args.buffer_size))
+                    while True:
+                        n = source.readinto(view)
+                        if not n:
+                            break
+                        if compressor is None:
+                            self.socket.sendall(view[:n])
+                            continue
+                        self.socket.sendall(compressor.compress(view[:n]))
+                        if n < len(view):
+                            # stdin has nothing more for now: do not sit on
+                            # what it gave us
+                            self.socket.sendall(compressor.sync())
+                    if compressor is not None:
+                        self.socket.sendall(compressor.flush())
+                        print(f'[*] {compressor.summary(time.perf_counter() - start)}', file=sys.stderr)
+            self.socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            # the other side is gone, stream() sees it too
+            pass
+
+    # a fixed pool of --workers threads serves the sessions. at most
+    # --max-inflight sessions are accepted and not yet finished (running or
+    # waiting for a worker); past that the listener stops accepting and new
+    # clients wait in the --backlog listen queue, so a flood costs neither
+    # threads nor memory. a client silent for --idle-timeout seconds is
+    # dropped
     def listen(self):
         self.socket.bind((self.args.target, self.args.port))
-        self.socket.listen(5)
+        self.socket.listen(self.args.backlog)
+        self.stats = stats = ListenerStats()
+        slots = threading.BoundedSemaphore(max(self.args.max_inflight, self.args.workers))
+        jobs = queue.SimpleQueue()
+        for _ in range(self.args.workers):
+            threading.Thread(target=self._worker, args=(jobs, slots), daemon=True).start()
+        if self.args.stats_interval:
+            threading.Thread(target=self._report, daemon=True).start()
+        try:
+            while True:
+                if not slots.acquire(blocking=False):
+                    start = time.perf_counter()
+                    slots.acquire()
+                    with stats.lock:
+                        stats.stalls += 1
+                        stats.stalled += time.perf_counter() - start
+                try:
+                    client_socket, address = self.socket.accept()
+                except OSError as e:
+                    # out of file descriptors and the like
+                    print(f'[!] accept failed: {e}')
+                    slots.release()
+                    time.sleep(0.1)
+                    continue
+                with stats.lock:
+                    stats.accepted += 1
+                jobs.put((client_socket, address, time.perf_counter()))
+        except KeyboardInterrupt:
+            print(f'[*] {stats}')
+            self.socket.close()
+
+    def _worker(self, jobs, slots):
         while True:
-            client_socket, _ = self.socket.accept()
-            client_thread = threading.Thread(target=self.handle, args=(client_socket,))
-            client_thread.start()
+            client_socket, address, accepted = jobs.get()
+            try:
+                self._session(client_socket, address, accepted)
+            finally:
+                slots.release()
+
+    def _session(self, client_socket, address, accepted):
+        start = time.perf_counter()
+        active = self.stats.start(start - accepted)
+        if self.args.idle_timeout:
+            client_socket.settimeout(self.args.idle_timeout)
+        error = None
+        try:
+            self.handle(client_socket)
+        except Exception as e:
+            # whatever went wrong, the worker lives on to serve the next one
+            error = e
+        finally:
+            client_socket.close()
+            duration = time.perf_counter() - start
+            self.stats.finish(duration, error)
+        ending = f', {"idle timeout" if isinstance(error, TimeoutError) else error}' if error else ''
+        print(f'[*] session {address[0]}:{address[1]}: {duration:.2f}s, waited '
+              f'{(start - accepted) * 1000:.2f} ms for a worker, {active} active{ending}')
+
+    def _report(self):
+        while True:
+            time.sleep(self.args.stats_interval)
+            print(f'[*] {self.stats}')
 
     def handle(self, client_socket):
         if self.args.execute:
-            output = execute(self.args.execute)
-            client_socket.send(output.encode())
+            try:
+                CommandSession(client_socket, self.args.command_timeout).execute(self.args.execute)
+            except OSError:
+                pass
+            client_socket.close()
         elif self.args.upload:
-            file_buffer = b''
-            while True:
-                data = client_socket.recv(4096)
-                if data:
-                    file_buffer += data
-                else:
-                    break
-            with open(self.args.upload, 'wb') as f:
-                f.write(file_buffer)
-            message = f'Save file {self.args.upload}'
-            client_socket.send(message.encode())
+            source = accept_compression(client_socket)
+            size, expected, seconds, digest = receive_file(source, self.args.upload)
+            rate = size / seconds / (1024 * 1024) if seconds else 0
+            message = f'Save file {self.args.upload}: {size} bytes in {seconds:.2f}s ({rate:,.1f} MB/s), sha256 {digest}'
+            if source is not client_socket:
+                ratio = size / source.wire if source.wire else 0
+                message += f', {source.wire} bytes on the wire with {source.method} ({ratio:.1f}x)'
+            if expected is not None and size != expected:
+                message += f', INCOMPLETE: expected {expected} bytes'
+            print(f'[*] {message}')
+            try:
+                client_socket.sendall(message.encode())
+            except OSError:
+                pass
+            client_socket.close()
         elif self.args.command:
-            cmd_buffer = b''
+            if not self.sessions.acquire(blocking=False):
+                try:
+                    client_socket.sendall(b'[!] too many sessions, try again later\n')
+                except OSError:
+                    pass
+                client_socket.close()
+                return
+            try:
+                CommandSession(client_socket, self.args.command_timeout).run()
+            finally:
+                self.sessions.release()
+
+# one client of the command shell. commands are newline terminated lines,
+# read through a buffer that never holds more than max_line bytes plus one
+# recv; a longer line is refused and skipped. each command runs with its
+# stdout and stderr sent back as they are produced, and is killed, along
+# with anything it started, if it is still running after `timeout` seconds
+# or its output cannot be sent
+class CommandSession:
+    def __init__(self, sock, timeout=30.0, max_line=MAX_LINE):
+        self.sock = sock
+        self.timeout = timeout
+        self.max_line = max_line
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.skipping = False
+
+    def run(self):
+        try:
+            self.sock.sendall(PROMPT)
             while True:
+                line = self.read_line()
+                if line is None:
+                    break
+                if line.strip():
+                    self.execute(line)
+                self.sock.sendall(PROMPT)
+        finally:
+            self.sock.close()
+
+    # the next line, without its newline, or None at end of stream
+    def read_line(self):
+        while True:
+            end = self.buffer.find(b'\n', self.scanned)
+            if end >= 0:
+                line = bytes(self.buffer[:end])
+                del self.buffer[:end + 1]
+                self.scanned = 0
+                if not self.skipping:
+                    return line.decode(errors='replace')
+                self.skipping = False
+                continue
+            # no need to look at these bytes again
+            self.scanned = len(self.buffer)
+            if len(self.buffer) > self.max_line:
+                if not self.skipping:
+                    self.sock.sendall(f'[!] line over {self.max_line} bytes, skipped\n'.encode())
+                    self.skipping = True
+                self.buffer.clear()
+                self.scanned = 0
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.buffer += data
+
+    def execute(self, line):
+        try:
+            command = shlex.split(line)
+        except ValueError as e:
+            self.sock.sendall(f'[!] {e}\n'.encode())
+            return
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            self.sock.sendall(f'[!] {e}\n'.encode())
+            return
+        output = process.stdout.fileno()
+        deadline = time.monotonic() + self.timeout
+        killed = None
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(output, selectors.EVENT_READ)
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not selector.select(remaining):
+                        killed = f'timed out after {self.timeout:g}s'
+                        break
+                    data = os.read(output, 65536)
+                    if not data:
+                        # output closed, the command may still be exiting
+                        try:
+                            process.wait(max(deadline - time.monotonic(), 0))
+                        except subprocess.TimeoutExpired:
+                            killed = f'timed out after {self.timeout:g}s'
+                        break
+                    # a client that is gone fails here, and the command
+                    # is killed below
+                    self.sock.sendall(data)
+        finally:
+            if killed or process.poll() is None:
                 try:
-                    client_socket.send(b'BHP: #>')
-                    while '\n' not in cmd_buffer.decode():
-                        cmd_buffer += client_socket.recv(64)
-                        response = execute(cmd_buffer.decode())
-                        if response:
-                            client_socket.send(response.encode())
-                            cmd_buffer = b''
-                except Exception as e:
-                    print(f'server killed {e}')
-                    self.socket.close()
-                    sys.exit()
-
-          
-
-def execute(cmd):
-    cmd = cmd.strip()
-    if not cmd:
-        return
-    output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT)
-    return output.decode()
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            process.stdout.close()
+            process.wait()
+        if killed:
+            print(f'[!] killed {line!r}: {killed}')
+            self.sock.sendall(f'[!] killed: {killed}\n'.encode())
+
+
+# streams an upload to `path` as it arrives: every recv lands in the same
+# buffer and goes straight to disk and into a sha256, so memory stays
+# constant whatever the size. a SIZE_HEADER up front gets the file
+# preallocated and ends the upload after that many bytes, without one the
+# upload runs to end of stream. returns (bytes written, expected size or
+# None, seconds, hex digest)
+def receive_file(sock, path, chunk_size=CHUNK):
+    view = memoryview(bytearray(chunk_size))
+    digest = hashlib.sha256()
+    start = time.perf_counter()
+    # the first bytes either are a header or already belong to the file
+    received = 0
+    while received < SIZE_HEADER.size:
+        n = sock.recv_into(view[received:SIZE_HEADER.size])
+        if not n:
+            break
+        received += n
+    expected = None
+    head = view[:received]
+    if received == SIZE_HEADER.size and head[:4] == SIZE_MAGIC:
+        expected = SIZE_HEADER.unpack(head)[1]
+        head = head[:0]
+    size = 0
+    with open(path, 'wb', buffering=0) as f:
+        if expected:
+            try:
+                os.posix_fallocate(f.fileno(), 0, expected)
+            except (AttributeError, OSError):
+                pass
+        chunk = head
+        try:
+            while True:
+                if len(chunk):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    while len(chunk):
+                        chunk = chunk[f.write(chunk):]
+                remaining = chunk_size if expected is None else min(chunk_size, expected - size)
+                if remaining <= 0:
+                    break
+                n = sock.recv_into(view, remaining)
+                if not n:
+                    break
+                chunk = view[:n]
+        finally:
+            if expected is not None and size < expected:
+                # do not leave the preallocated tail behind
+                f.truncate(size)
+    return size, expected, time.perf_counter() - start, digest.hexdigest()
+
+# sends a file with a SIZE_HEADER, straight from the page cache where the
+# platform allows, or a chunk at a time through `compressor`
+def send_file(sock, path, compressor=None):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        header = SIZE_HEADER.pack(SIZE_MAGIC, size)
+        if compressor is None:
+            sock.sendall(header)
+            sock.sendfile(f)
+            return size
+        sock.sendall(compressor.compress(header))
+        view = memoryview(bytearray(CHUNK))
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            sock.sendall(compressor.compress(view[:n]))
+        sock.sendall(compressor.flush())
+    return size
+
+# the sending side of a compressed stream, one chunk in and (usually less)
+# out at a time, so memory is bounded by the chunk and the method's own
+# window, whatever the total size
+class Compressor:
+    def __init__(self, method='zlib', level=6):
+        self.method = method
+        if method == 'zlib':
+            self.compressor = zlib.compressobj(level)
+        else:
+            self.compressor = lzma.LZMACompressor(preset=level)
+        self.raw = 0
+        self.wire = 0
+
+    def compress(self, data):
+        self.raw += len(data)
+        out = self.compressor.compress(data)
+        self.wire += len(out)
+        return out
+
+    # whatever is held back, without ending the stream. lzma cannot do that
+    # short of ending a block, so it keeps its data until flush()
+    def sync(self):
+        if self.method != 'zlib':
+            return b''
+        out = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wire += len(out)
+        return out
+
+    def flush(self):
+        out = self.compressor.flush()
+        self.wire += len(out)
+        return out
+
+    def summary(self, seconds):
+        ratio = self.raw / self.wire if self.wire else 0
+        rate = self.raw / seconds / (1024 * 1024) if seconds else 0
+        return (f'{self.method}: {self.raw} bytes sent as {self.wire} ({ratio:.1f}x) in {seconds:.2f}s, '
+                f'{rate:,.1f} MB/s effective')
+
+# the receiving side: wraps a socket and hands out decompressed data through
+# the socket's recv_into, never more than asked for, so the decompressor's
+# output stays bounded by the caller's buffer
+class DecompressingReader:
+    def __init__(self, sock, method):
+        self.sock = sock
+        self.method = method
+        if method == 'zlib':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = lzma.LZMADecompressor()
+        self.pending = b''
+        self.wire = 0
+
+    def recv_into(self, view, nbytes=0):
+        nbytes = nbytes or len(view)
+        decompressor = self.decompressor
+        while True:
+            try:
+                if self.method == 'zlib':
+                    data = decompressor.decompress(self.pending, nbytes)
+                    self.pending = decompressor.unconsumed_tail
+                elif not decompressor.eof and (self.pending or not decompressor.needs_input):
+                    data = decompressor.decompress(self.pending, nbytes)
+                    self.pending = b''
+                else:
+                    data = b''
+            except (zlib.error, lzma.LZMAError) as e:
+                raise ConnectionError(f'corrupt {self.method} stream: {e}')
+            if data:
+                view[:len(data)] = data
+                return len(data)
+            if decompressor.eof:
+                return 0
+            chunk = self.sock.recv(CHUNK)
+            if not chunk:
+                return 0
+            self.wire += len(chunk)
+            self.pending = chunk
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+# offers `method` to the listener and returns a Compressor if it agrees,
+# None to send plain bytes
+def offer_compression(sock, method, level=6):
+    sock.sendall(OFFER.pack(OFFER_MAGIC, METHODS[method]))
+    # an older listener takes the offer for data and never answers, a
+    # listener in another mode answers something else
+    sock.settimeout(10)
+    try:
+        reply = recv_exactly(sock, ACK.size)
+    finally:
+        sock.settimeout(None)
+    if len(reply) < ACK.size or reply[:4] != ACK_MAGIC:
+        raise ConnectionError('the listener did not answer the compression offer')
+    if ACK.unpack(reply)[1] != METHODS[method]:
+        print(f'[!] the listener refused {method}, sending uncompressed', file=sys.stderr)
+        return None
+    return Compressor(method, level)
+
+# the listener's side of the handshake: a stream that starts with an offer
+# gets its answer and comes back wrapped in a DecompressingReader, anything
+# else is returned as is, untouched
+def accept_compression(sock):
+    if sock.recv(4, socket.MSG_PEEK | socket.MSG_WAITALL) != OFFER_MAGIC:
+        return sock
+    _, method = OFFER.unpack(recv_exactly(sock, OFFER.size))
+    name = {number: name for name, number in METHODS.items()}.get(method)
+    sock.sendall(ACK.pack(ACK_MAGIC, method if name else 0))
+    return DecompressingReader(sock, name) if name else sock
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+# sixteen different megabytes of log-like text, for compression; more
+# than one lzma dictionary at the default level, so it cannot just match
+# the previous copy
+def _log_blocks():
+    blocks = []
+    for index in range(16):
+        lines = []
+        size = 0
+        line_no = index * 20000
+        while size < CHUNK:
+            line_no += 1
+            line = (f'2024-05-{line_no % 28 + 1:02d}T{line_no % 24:02d}:{line_no % 60:02d}:{line_no * 7 % 60:02d} '
+                    f'host{line_no % 7} sshd[{1000 + line_no % 500}]: Accepted publickey for user{line_no % 13} '
+                    f'from 10.{line_no % 3}.{line_no % 256}.{line_no * 7 % 256} port {40000 + line_no % 20000}\n')
+            lines.append(line.encode())
+            size += len(lines[-1])
+        blocks.append(b''.join(lines)[:CHUNK])
+    return blocks
+
+# uploads a `megabytes` file over loopback into receive_file and compares
+# with writing the same amount straight to disk in the same directory; the
+# peak RSS shows the receiver does not hold the file. with `compress` the
+# file is log-like text and goes through the compression handshake
+def benchmark_upload(megabytes=512, directory=None, compress=None, level=6):
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        source = os.path.join(tmp, 'source')
+        blocks = _log_blocks() if compress else [os.urandom(CHUNK)]
+        start = time.perf_counter()
+        with open(source, 'wb') as f:
+            for index in range(megabytes):
+                f.write(blocks[index % len(blocks)])
+            f.flush()
+            os.fsync(f.fileno())
+        disk = megabytes / (time.perf_counter() - start)
+        print(f'[*] disk write: {disk:,.0f} MB/s')
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        server = socket.create_server(('127.0.0.1', 0))
+        result = []
+
+        def receive():
+            client, _ = server.accept()
+            with client:
+                reader = accept_compression(client)
+                result.append(receive_file(reader, os.path.join(tmp, 'upload')))
+                client.sendall(b'done')
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        with socket.create_connection(server.getsockname()) as sock:
+            compressor = offer_compression(sock, compress, level) if compress else None
+            send_file(sock, source, compressor)
+            recv_all(sock)
+        receiver.join()
+        server.close()
+        size, _, seconds, digest = result[0]
+        with open(source, 'rb') as f:
+            ok = hashlib.file_digest(f, 'sha256').hexdigest() == digest
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'[*] upload: {size / (1024 * 1024):.0f} MB in {seconds:.2f}s, '
+              f'{size / seconds / (1024 * 1024):,.0f} MB/s, digest {"ok" if ok else "MISMATCH"}, '
+              f'peak RSS {rss:.1f} -> {peak:.1f} MB')
+        if compressor:
+            print(f'[*] {compressor.summary(seconds)}')
+
+def _sink(server, megabytes, done):
+    client, _ = server.accept()
+    with client:
+        view = memoryview(bytearray(CHUNK))
+        received = 0
+        while received < megabytes * 1024 * 1024:
+            n = client.recv_into(view)
+            if not n:
+                break
+            received += n
+        done.append((time.perf_counter(), received))
+
+def _source(server, block, megabytes):
+    client, _ = server.accept()
+    with client:
+        try:
+            for _ in range(megabytes):
+                client.sendall(block)
+        except OSError:
+            # the old client hangs up after its first short read
+            pass
+
+# pipes `megabytes` through this script as a client over loopback, once
+# with --stream and once the old way, in both directions: stdin to a
+# server that counts what arrives, and a server's output to stdout. the
+# payload is text so the old path can decode it
+def benchmark_stream(megabytes=256, buffer_size=STREAM_BUFFER):
+    block = (b'0123456789abcdef' * 4095 + b'0123456789abcde\n') * (CHUNK // 65536)
+    total = megabytes * len(block)
+    with tempfile.TemporaryFile() as payload:
+        for _ in range(megabytes):
+            payload.write(block)
+        payload.flush()
+        for label, flags in (('stream', ['--stream', '-b', str(buffer_size)]), ('legacy', [])):
+            server = socket.create_server(('127.0.0.1', 0))
+            done = []
+            receiver = threading.Thread(target=_sink, args=(server, megabytes, done), daemon=True)
+            receiver.start()
+            payload.seek(0)
+            command = [sys.executable, os.path.abspath(__file__), '-t', '127.0.0.1', '-p',
+                       str(server.getsockname()[1])] + flags
+            start = time.perf_counter()
+            client = subprocess.Popen(command, stdin=payload, stdout=subprocess.DEVNULL)
+            receiver.join(60)
+            client.kill()
+            client.wait()
+            server.close()
+            if done:
+                finished, received = done[0]
+                print(f'[*] {label} upload: {received / (1024 * 1024):.0f} of {megabytes} MB, '
+                      f'{received / (finished - start) / (1024 * 1024):,.0f} MB/s')
+            else:
+                print(f'[*] {label} upload: did not finish')
+
+            server = socket.create_server(('127.0.0.1', 0))
+            threading.Thread(target=_source, args=(server, block, megabytes), daemon=True).start()
+            command[5] = str(server.getsockname()[1])
+            start = time.perf_counter()
+            client = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+            received = 0
+            while True:
+                data = client.stdout.read1(CHUNK)
+                if not data:
+                    break
+                received += len(data)
+                # the old client only stops on end of stdin after printing
+                if received >= total:
+                    break
+            elapsed = time.perf_counter() - start
+            client.kill()
+            client.wait()
+            client.stdout.close()
+            server.close()
+            print(f'[*] {label} download: {received / (1024 * 1024):.0f} of {megabytes} MB, '
+                  f'{received / elapsed / (1024 * 1024):,.0f} MB/s')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='BHP Net Tool', \
@@ -98,8 +753,11 @@ if __name__ == '__main__':
                                 epilog=textwrap.dedent('''Example: 
                                                         netcat.py -t 192.168.1.108 -p 5555 -l -c # command shell
                                                         netcat.py -t 192.168.1.108 -p 5555 -l -u=mytest.txt # upload to file
+                                                        netcat.py -t 192.168.1.108 -p 5555 -f=mytest.txt # send a file to an upload listener
+                                                        netcat.py -t 192.168.1.108 -p 5555 -f=app.log -z zlib # ... compressed
                                                         netcat.py -t 192.168.1.108 -p 5555 -l -e=\"cat/etc/passwd\" # execute command
                                                         echo 'ABC' | ./netcat.py -t 192.168.1.108 -p 135 # echo text to server port 135
+                                                        tar c dir | ./netcat.py -t 192.168.1.108 -p 5555 -s > reply # full duplex raw bytes
                                                         netcat.py -t 192.168.1.108 -p 5555 # connect to server
                                                        '''))
     parser.add_argument('-c', '--command', action='store_true', help='command shell')
@@ -108,8 +766,43 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', type=int, default=5555, help='specified port')
     parser.add_argument('-t', '--target', default='192.168.64.2', help='specified IP')
     parser.add_argument('-u', '--upload', help='upload file')
+    parser.add_argument('-f', '--file', help='send this file to an upload listener, with its size')
+    parser.add_argument('--command-timeout', type=float, default=30.0,
+                        help='kill a shell or -e command still running after this many seconds')
+    parser.add_argument('--max-sessions', type=int,
+                        help='command shell sessions at once, fewer than --workers (default half of them)')
+    parser.add_argument('--workers', type=int, default=16, help='listener threads serving sessions')
+    parser.add_argument('--max-inflight', type=int, default=64,
+                        help='sessions accepted and not finished, more wait in the listen queue')
+    parser.add_argument('--backlog', type=int, default=128, help='listen queue length')
+    parser.add_argument('--idle-timeout', type=float, default=300.0,
+                        help='drop a client silent for this many seconds, 0 for never')
+    parser.add_argument('--stats-interval', type=float, default=0, help='print listener stats every N seconds')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='pipe stdin to the target and the target to stdout, as raw bytes')
+    parser.add_argument('-b', '--buffer-size', type=int, default=STREAM_BUFFER, help='read size for --stream')
+    parser.add_argument('-z', '--compress', choices=sorted(METHODS),
+                        help='offer compressed transfer to an upload listener of this version (with -f or --stream)')
+    parser.add_argument('--level', type=int, default=6, choices=range(10), metavar='0-9', help='compression level')
+    parser.add_argument('--benchmark', type=int, metavar='MB', help='time an upload of MB megabytes over loopback')
+    parser.add_argument('--stream-benchmark', type=int, metavar='MB',
+                        help='pipe MB megabytes through --stream and the old client over loopback')
     args = parser.parse_args()
-    if args.listen:
+    # shells hold a worker for their whole life: at --workers or more they
+    # would take the whole pool and extra clients would only queue
+    if args.max_sessions is None:
+        args.max_sessions = max(1, args.workers // 2)
+    elif args.command and args.max_sessions >= args.workers:
+        parser.error('--max-sessions must be below --workers')
+    if args.compress and not (args.file or args.stream or args.benchmark):
+        parser.error('--compress needs -f or --stream')
+    if args.benchmark:
+        benchmark_upload(args.benchmark, compress=args.compress, level=args.level)
+        sys.exit()
+    if args.stream_benchmark:
+        benchmark_stream(args.stream_benchmark, args.buffer_size)
+        sys.exit()
+    if args.listen or args.file or args.stream:
         buffer = ''
     else:
         buffer = sys.stdin.read()
@@ -0,0 +1,170 @@
+import csv
+import io
+import json
+import queue
+import sys
+import threading
+import time
+
+FIELDS = ['time', 'scanner', 'event', 'host', 'port', 'state', 'rtt', 'service', 'banner', 'src_port', 'dst_port']
+
+# how each event reads on the console
+CONSOLE_FORMATS = {
+    'host_up': 'Host Up: {host}',
+    'port_open': '{host} -> Port {port} open',
+    'port': '{host}:{port} {state}',
+    'tcp_packet': 'TCP Packet -> Source Port: {src_port}, Destination Port: {dst_port}',
+    'udp_packet': 'UDP Packet -> Source Port: {src_port}, Destination Port: {dst_port}',
+}
+
+# a buffered writer for scan results. emit() only formats into a memory
+# buffer; the buffer goes out to the stream when it grows past
+# `buffer_size` or `flush_interval` seconds have passed. with
+# background=True, emit() just queues the record and a writer thread does
+# the formatting and the I/O, so the scan loop never waits on the terminal
+# or the disk.
+class ResultSink:
+    def __init__(self, stream, flush_interval=1.0, buffer_size=64 * 1024, background=False):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.buffer = io.StringIO()
+        self.flushed_at = time.monotonic()
+        self.count = 0
+        self.queue = None
+        if background:
+            self.queue = queue.SimpleQueue()
+            self.thread = threading.Thread(target=self._drain, daemon=True)
+            self.thread.start()
+
+    def format(self, record):
+        raise NotImplementedError
+
+    def emit(self, event, **fields):
+        record = {'time': round(time.time(), 6), 'event': event, **fields}
+        if self.queue is not None:
+            self.queue.put(record)
+        else:
+            self._write(record)
+
+    def _write(self, record):
+        self.buffer.write(self.format(record))
+        self.count += 1
+        if self.buffer.tell() >= self.buffer_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self._flush()
+
+    def _flush(self):
+        data = self.buffer.getvalue()
+        if data:
+            self.stream.write(data)
+            self.stream.flush()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        self.flushed_at = time.monotonic()
+
+    def _drain(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush()
+                continue
+            if record is None:
+                break
+            self._write(record)
+        self._flush()
+
+    def flush(self):
+        if self.queue is None:
+            self._flush()
+
+    # called by scan loops when they are between results, so the tail of a
+    # burst does not sit in the buffer until the next emit
+    def poll(self):
+        if self.queue is None and time.monotonic() - self.flushed_at >= self.flush_interval:
+            self._flush()
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+        else:
+            self._flush()
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+
+class JSONLSink(ResultSink):
+    def format(self, record):
+        return json.dumps(record, separators=(',', ':')) + '\n'
+
+class CSVSink(ResultSink):
+    def __init__(self, stream, *args, **kwargs):
+        super().__init__(stream, *args, **kwargs)
+        self.writer = csv.DictWriter(self.buffer, FIELDS, extrasaction='ignore', lineterminator='\n')
+        # appending to an existing results file keeps its header
+        try:
+            fresh = stream.tell() == 0
+        except (OSError, ValueError):
+            fresh = True
+        if fresh:
+            self.writer.writeheader()
+
+    def format(self, record):
+        self.writer.writerow(record)
+        return ''
+
+class ConsoleSink(ResultSink):
+    def format(self, record):
+        template = CONSOLE_FORMATS.get(record['event'])
+        if template is None:
+            return ' '.join(f'{key}={value}' for key, value in record.items() if key != 'time') + '\n'
+        line = template.format_map(record)
+        if record.get('service'):
+            line += f" [{record['service']}] {record.get('banner') or ''}"
+        return line + '\n'
+
+# fans every result out to the console and/or a results file
+class SinkGroup:
+    def __init__(self, sinks, scanner=None):
+        self.sinks = sinks
+        self.scanner = scanner
+
+    def emit(self, event, **fields):
+        if self.scanner:
+            fields.setdefault('scanner', self.scanner)
+        for sink in self.sinks:
+            sink.emit(event, **fields)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def poll(self):
+        for sink in self.sinks:
+            sink.poll()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+def open_sinks(scanner, output=None, fmt=None, quiet=False, background=False, flush_interval=1.0):
+    sinks = []
+    if not quiet:
+        # the console is flushed often so results still show up promptly
+        sinks.append(ConsoleSink(sys.stdout, min(flush_interval, 0.2), background=background))
+    if output:
+        fmt = fmt or ('csv' if output.endswith('.csv') else 'jsonl')
+        stream = sys.stdout if output == '-' else open(output, 'a', newline='', buffering=1024 * 1024)
+        sink_class = CSVSink if fmt == 'csv' else JSONLSink
+        sinks.append(sink_class(stream, flush_interval, background=background))
+    return SinkGroup(sinks, scanner)
+
+def add_arguments(parser):
+    parser.add_argument('-o', '--output', metavar='FILE', help='also write results to FILE (- for stdout)')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='results file format, by default from the extension')
+    parser.add_argument('-q', '--quiet', action='store_true', help='no console output of results')
+    parser.add_argument('--writer-thread', action='store_true', help='format and write results on a background thread')
+    parser.add_argument('--flush-interval', type=float, default=1.0, help='seconds between results file flushes')
+
+def sinks_from_args(scanner, args):
+    return open_sinks(scanner, args.output, args.format, args.quiet, args.writer_thread, args.flush_interval)
@@ -0,0 +1,100 @@
+import json
+import os
+import struct
+import time
+
+from scanner import HostBitmap
+
+MAGIC = b'PYSCAN\x01\n'
+HEADER_LEN = struct.Struct('!I')
+
+# on-disk checkpoint for long sweeps. the file is a short JSON header (what
+# was being scanned, the target cursor and the open ports found so far)
+# followed by two raw bitmaps keyed by target offset: hosts seen alive and
+# hosts that are completely finished. saves are atomic (write + rename) and
+# throttled to one every `interval` seconds, so the cost stays bounded no
+# matter how many results come in.
+class Checkpoint:
+    def __init__(self, path, key, size, interval=5.0):
+        self.path = path
+        self.key = key
+        self.size = size
+        self.interval = interval
+        self.cursor = 0
+        self.live = HostBitmap(size)
+        self.done = HostBitmap(size)
+        self.ports = {}
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+    # picks up the checkpoint at `path` if there is one for the same scan,
+    # otherwise starts a fresh one
+    @classmethod
+    def open(cls, path, key, size, resume=False, interval=5.0):
+        checkpoint = cls(path, key, size, interval)
+        if not resume:
+            return checkpoint
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            print(f'[*] No checkpoint at {path}, starting from scratch')
+            return checkpoint
+        if not data.startswith(MAGIC):
+            raise ValueError(f'{path} is not a scan checkpoint')
+        offset = len(MAGIC)
+        header_len, = HEADER_LEN.unpack_from(data, offset)
+        offset += HEADER_LEN.size
+        header = json.loads(data[offset:offset + header_len])
+        offset += header_len
+        if header['key'] != key or header['size'] != size:
+            raise ValueError(f'{path} belongs to a different scan ({header["key"]})')
+        bitmap_len = len(checkpoint.live.bits)
+        checkpoint.cursor = header['cursor']
+        checkpoint.ports = {int(target): ports for target, ports in header['ports'].items()}
+        checkpoint.live.bits[:] = data[offset:offset + bitmap_len]
+        checkpoint.done.bits[:] = data[offset + bitmap_len:offset + 2 * bitmap_len]
+        checkpoint.live.count = sum(bin(byte).count('1') for byte in checkpoint.live.bits)
+        checkpoint.done.count = sum(bin(byte).count('1') for byte in checkpoint.done.bits)
+        print(f'[*] Resuming from {path}: cursor {checkpoint.cursor}/{size}, '
+              f'{len(checkpoint.live)} live, {len(checkpoint.done)} finished')
+        return checkpoint
+
+    def advance(self, cursor):
+        if cursor != self.cursor:
+            self.cursor = cursor
+            self.dirty = True
+
+    def mark_live(self, target):
+        if self.live.add(target):
+            self.dirty = True
+
+    def mark_done(self, target):
+        if self.done.add(target):
+            self.dirty = True
+
+    def add_port(self, target, port):
+        self.ports.setdefault(target, []).append(port)
+        self.dirty = True
+
+    def maybe_save(self):
+        if self.dirty and time.monotonic() - self.saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        header = json.dumps({
+            'key': self.key,
+            'size': self.size,
+            'cursor': self.cursor,
+            'ports': self.ports,
+        }, separators=(',', ':')).encode()
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(HEADER_LEN.pack(len(header)))
+            f.write(header)
+            f.write(self.live.bits)
+            f.write(self.done.bits)
+        os.replace(tmp, self.path)
+        self.dirty = False
+        self.saved_at = time.monotonic()
@@ -1,84 +1,414 @@
+import argparse
+import bisect
+import collections
+import errno
 import ipaddress
+import itertools
 import os
+import queue
+import selectors
 import socket
 import struct
 import sys
 import threading
 import time
 
+import scan_output
+
 # subnet to target
 SUBNET = '192.168.1.0/24'
 # magic string we'll check ICMP responses for
 MESSAGE = 'PYTHONRULES!'
 
+# map protocol constants to their names
+PROTOCOL_MAP = {1: "ICMP", 6: "TCP", 17: "UDP"}
+IPV4 = struct.Struct('!I')
+
+# the header classes decode straight out of a memoryview with precompiled
+# structs, so building one costs a single unpack_from and no slice copies
 class IP:
-    def __init__(self, buff=None):
-        header = struct.unpack('<BBHHHBBH4s4s', buff)
-        self.ver = header[0] >> 4
-        self.ihl = header[0] & 0xF
-
-        self.tos = header[1]
-        self.len = header[2]
-        self.id = header[3]
-        self.offset = header[4]
-        self.ttl = header[5]
-        self.protocol_num = header[6]
-        self.sum = header[7]
-        self.src = header[8]
-        self.dst = header[9]
-
-        2 # human readable IP addresses
-        self.src_address = ipaddress.ip_address(self.src)
-        self.dst_address = ipaddress.ip_address(self.dst)
-
-        # map protocol constants to their names
-        self.protocol_map = {1: "ICMP", 6: "TCP", 17: "UDP"}
-        try:
-            self.protocol = self.protocol_map[self.protocol_num]
-        except Exception as e:
-            print('%s No protocol for %s' % (e, self.protocol_num))
-            self.protocol = str(self.protocol_num)
+    __slots__ = ('ver', 'ihl', 'tos', 'len', 'id', 'offset', 'ttl',
+                 'protocol_num', 'sum', 'src', 'dst')
+    _header = struct.Struct('!BBHHHBBH4s4s')
+
+    def __init__(self, buff=None, offset=0):
+        (ver_ihl, self.tos, self.len, self.id, self.offset, self.ttl,
+         self.protocol_num, self.sum, self.src, self.dst) = self._header.unpack_from(buff, offset)
+        self.ver = ver_ihl >> 4
+        self.ihl = ver_ihl & 0xF
+
+    # human readable IP addresses, only built when somebody asks for them
+    @property
+    def src_address(self):
+        return ipaddress.IPv4Address(self.src)
+
+    @property
+    def dst_address(self):
+        return ipaddress.IPv4Address(self.dst)
+
+    @property
+    def src_int(self):
+        return int.from_bytes(self.src, 'big')
+
+    @property
+    def protocol(self):
+        return PROTOCOL_MAP.get(self.protocol_num, str(self.protocol_num))
 
 class ICMP:
-    def __init__(self, buff):
-        header = struct.unpack('<BBHHH', buff)
-        self.type = header[0]
-        self.code = header[1]
-        self.sum = header[2]
-        self.id = header[3]
-        self.seq = header[4]
+    __slots__ = ('type', 'code', 'sum', 'id', 'seq')
+    _header = struct.Struct('!BBHHH')
+
+    def __init__(self, buff, offset=0):
+        (self.type, self.code, self.sum,
+         self.id, self.seq) = self._header.unpack_from(buff, offset)
 
 class TCP:
-    def __init__(self, buff):
-        header = struct.unpack('!HHLLBBHHH', buff)
-        self.src_port = header[0]
-        self.dst_port = header[1]
-        self.sequence = header[2]
-        self.acknowledgment = header[3]
-        self.offset_reserved = header[4]
-        self.tcp_flags = header[5]
-        self.window = header[6]
-        self.checksum = header[7]
-        self.urgent_pointer = header[8]
-        self.offset = (self.offset_reserved >> 4) * 4
+    __slots__ = ('src_port', 'dst_port', 'sequence', 'acknowledgment',
+                 'offset_reserved', 'tcp_flags', 'window', 'checksum',
+                 'urgent_pointer')
+    _header = struct.Struct('!HHLLBBHHH')
+
+    def __init__(self, buff, offset=0):
+        (self.src_port, self.dst_port, self.sequence, self.acknowledgment,
+         self.offset_reserved, self.tcp_flags, self.window, self.checksum,
+         self.urgent_pointer) = self._header.unpack_from(buff, offset)
+
+    @property
+    def offset(self):
+        return (self.offset_reserved >> 4) * 4
 
 class UDP:
-    def __init__(self, buff):
-        header = struct.unpack('!HHHH', buff)
-        self.src_port = header[0]
-        self.dst_port = header[1]
-        self.length = header[2]
-        self.checksum = header[3]
-
-# this sprays out UDP datagrams with our magic message
-def udp_sender():
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
-        for ip in ipaddress.ip_network(SUBNET).hosts():
-            sender.sendto(bytes(MESSAGE, 'utf8'), (str(ip), 65212))
+    __slots__ = ('src_port', 'dst_port', 'length', 'checksum')
+    _header = struct.Struct('!HHHH')
+
+    def __init__(self, buff, offset=0):
+        (self.src_port, self.dst_port,
+         self.length, self.checksum) = self._header.unpack_from(buff, offset)
+
+# a sweep scope compiled once into sorted, non-overlapping integer ranges.
+# membership is a bisect over the range starts, and every address in scope
+# maps to a dense offset so per-host state can live in a bitmap
+class TargetScope:
+    def __init__(self, include=(SUBNET,), exclude=()):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        ranges = self._subtract(self._compile(self.include, hosts=True),
+                                self._compile(self.exclude, hosts=False))
+        self.starts = [start for start, _ in ranges]
+        self.ends = [end for _, end in ranges]
+        self.bases = []
+        size = 0
+        for start, end in ranges:
+            self.bases.append(size)
+            size += end - start + 1
+        self.size = size
+
+    @staticmethod
+    def _compile(cidrs, hosts):
+        ranges = []
+        for cidr in cidrs:
+            network = ipaddress.IPv4Network(cidr, strict=False)
+            start, end = int(network.network_address), int(network.broadcast_address)
+            # like network.hosts(), skip the network and broadcast addresses
+            if hosts and network.prefixlen < 31:
+                start, end = start + 1, end - 1
+            ranges.append((start, end))
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def _subtract(ranges, holes):
+        result = []
+        for start, end in ranges:
+            for hole_start, hole_end in holes:
+                if hole_end < start or hole_start > end:
+                    continue
+                if hole_start > start:
+                    result.append((start, hole_start - 1))
+                start = hole_end + 1
+                if start > end:
+                    break
+            if start <= end:
+                result.append((start, end))
+        return result
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return ', '.join(self.include + [f'!{cidr}' for cidr in self.exclude])
+
+    def __contains__(self, addr):
+        return self.offset(addr) >= 0
+
+    # dense index of an address in the scope, -1 when it is out of scope
+    def offset(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr <= self.ends[i]:
+            return self.bases[i] + addr - self.starts[i]
+        return -1
+
+    def address(self, offset):
+        i = bisect.bisect_right(self.bases, offset) - 1
+        return self.starts[i] + offset - self.bases[i]
+
+    # addresses in scope as integers, optionally starting at an offset
+    def addresses(self, start=0):
+        for i, (first, last) in enumerate(zip(self.starts, self.ends)):
+            count = last - first + 1
+            if start >= self.bases[i] + count:
+                continue
+            yield from range(first + max(0, start - self.bases[i]), last + 1)
+
+# one bit per address in a TargetScope, keyed by the scope offset
+class HostBitmap:
+    __slots__ = ('bits', 'count')
+
+    def __init__(self, size):
+        self.bits = bytearray((size + 7) >> 3)
+        self.count = 0
+
+    # sets the bit and reports whether it was new
+    def add(self, offset):
+        mask = 1 << (offset & 7)
+        byte = self.bits[offset >> 3]
+        if byte & mask:
+            return False
+        self.bits[offset >> 3] = byte | mask
+        self.count += 1
+        return True
+
+    def __contains__(self, offset):
+        return bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (index << 3) | bit
+
+# hands out tokens at `rate` per second, up to `burst` at once; take()
+# sleeps until enough tokens have accumulated
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate / 100))
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def take(self, count=1):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return
+            time.sleep((count - self.tokens) / self.rate)
+
+# this sprays out UDP datagrams with our magic message. the payload is
+# encoded once, targets are encoded a batch at a time straight from the
+# scope's integer ranges, datagrams go out in batches paced by a token
+# bucket, and progress is reported as achieved rate and ETA
+class UDPSweeper:
+    def __init__(self, scope=None, rate=0, batch=32, port=65212, report_every=2.0, start=0, lag=2.0):
+        self.scope = scope or TargetScope()
+        self.start = start
+        self.cursor = start
+        # (time, cursor) per batch, only as far back as `lag` seconds
+        self.history = collections.deque([(time.monotonic(), start)])
+        self.history_lock = threading.Lock()
+        self.lag = lag
+        self.port = port
+        self.payload = bytes(MESSAGE, 'utf8')
+        self.batch = max(1, batch)
+        self.bucket = TokenBucket(rate, burst=max(self.batch, rate / 100)) if rate else None
+        self.report_every = report_every
+        self.sent = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def report(self, final=False):
+        total = len(self.scope) - self.start
+        rate = self.sent / self.elapsed if self.elapsed else 0.0
+        if final:
+            print(f'[*] Sent {self.sent}/{total} probes in {self.elapsed:.1f}s ({rate:,.0f} pps, {self.errors} errors)')
+        else:
+            eta = (total - self.sent) / rate if rate else 0.0
+            print(f'[*] Sent {self.sent}/{total} probes ({rate:,.0f} pps), ETA {eta:.0f}s')
+
+    # the cursor as it was `lag` seconds ago: every target before it has had
+    # time to answer, so a resumed sweep can safely skip them
+    def settled(self):
+        cutoff = time.monotonic() - self.lag
+        with self.history_lock:
+            self._forget(cutoff)
+            stamp, cursor = self.history[0]
+        return cursor if stamp <= cutoff else self.start
+
+    # drops the entries older than the newest one at or before cutoff
+    def _forget(self, cutoff):
+        history = self.history
+        while len(history) > 1 and history[1][0] <= cutoff:
+            history.popleft()
+
+    def run(self):
+        payload, bucket, port = self.payload, self.bucket, self.port
+        pack, ntoa = IPV4.pack, socket.inet_ntoa
+        addresses = self.scope.addresses(self.start)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sendto = sender.sendto
+            start = time.monotonic()
+            next_report = start + self.report_every
+            while True:
+                chunk = [(ntoa(pack(addr)), port) for addr in itertools.islice(addresses, self.batch)]
+                if not chunk:
+                    break
+                if bucket:
+                    bucket.take(len(chunk))
+                for addr in chunk:
+                    try:
+                        sendto(payload, addr)
+                    except OSError as e:
+                        # the local queue is full: back off briefly and retry once
+                        if e.errno != errno.ENOBUFS:
+                            self.errors += 1
+                            continue
+                        time.sleep(0.001)
+                        try:
+                            sendto(payload, addr)
+                        except OSError:
+                            self.errors += 1
+                            continue
+                    self.sent += 1
+                now = time.monotonic()
+                self.cursor += len(chunk)
+                with self.history_lock:
+                    self.history.append((now, self.cursor))
+                    self._forget(now - self.lag)
+                self.elapsed = now - start
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self.report_every
+            self.elapsed = time.monotonic() - start
+        self.report(final=True)
+
+def udp_sender(scope=None, rate=0, batch=32, start=0):
+    UDPSweeper(scope, rate, batch, start=start).run()
+
+# a fixed pool of receive slots, filled with recv_into by a reader thread.
+# the reader waits once, then drains everything the kernel has queued into
+# free slots and hands the batch to the sniff loop, which gives the slots
+# back once it has parsed them. nothing is allocated per packet. when every
+# slot is taken the reader waits for the sniff loop and leaves packets in
+# the kernel's receive buffer; with drop_when_full it reads and discards
+# them instead
+class PacketRing:
+    def __init__(self, sock, slots=1024, slot_size=2048, batch=64, drop_when_full=False):
+        self.sock = sock
+        self.slot_size = slot_size
+        self.batch = batch
+        self.drop_when_full = drop_when_full
+        self.views = [memoryview(bytearray(slot_size)) for _ in range(slots)]
+        self.free = collections.deque(range(slots))
+        self.freed = threading.Event()
+        self.ready = queue.SimpleQueue()
+        self.scratch = bytearray(slot_size) if drop_when_full else None
+        self.received = 0
+        self.full = 0
+        self.dropped = 0
+        self.truncated = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+
+    def start(self):
+        self.sock.setblocking(False)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _fill(self):
+        sock, views, free = self.sock, self.views, self.free
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        while not self._stop.is_set():
+            if not selector.select(0.5):
+                continue
+            batch = []
+            while len(batch) < self.batch:
+                if not free:
+                    if batch:
+                        break
+                    if self.drop_when_full:
+                        # keep the kernel queue moving through the scratch
+                        # slot and count what we had to throw away
+                        try:
+                            sock.recv_into(self.scratch)
+                        except BlockingIOError:
+                            break
+                        self.dropped += 1
+                        continue
+                    # the ring is full: wait for the sniff loop to give
+                    # slots back. clearing before the check means a wakeup
+                    # in between is not lost
+                    self.full += 1
+                    self.freed.clear()
+                    while not free and not self._stop.is_set():
+                        self.freed.wait(0.5)
+                    break
+                slot = free.popleft()
+                try:
+                    nbytes = sock.recv_into(views[slot])
+                except BlockingIOError:
+                    free.appendleft(slot)
+                    break
+                if nbytes == self.slot_size:
+                    self.truncated += 1
+                batch.append((slot, nbytes))
+            if batch:
+                self.received += len(batch)
+                self.ready.put(batch)
+        selector.close()
+
+    def batches(self):
+        views = self.views
+        while True:
+            try:
+                batch = self.ready.get(timeout=0.5)
+            except queue.Empty:
+                # an empty batch lets the sniff loop do its housekeeping
+                yield []
+                continue
+            yield [views[slot][:nbytes] for slot, nbytes in batch]
+            self.free.extend(slot for slot, _ in batch)
+            self.freed.set()
 
 class Scanner:
-    def __init__(self, host):
+    def __init__(self, host, scope=None, ring_slots=1024, slot_size=2048, batch=64,
+                 sweeper=None, checkpoint=None, sink=None, log_packets=False, ring_drop=False):
         self.host = host
+        self.sink = sink or scan_output.open_sinks('scanner')
+        self.log_packets = log_packets
+        self.scope = scope or TargetScope()
+        self.host_offset = self.scope.offset(int(ipaddress.IPv4Address(host)))
+        self.message = bytes(MESSAGE, 'utf8')
+        self.sweeper = sweeper
+        self.checkpoint = checkpoint
+        # a checkpoint brings back the hosts found before the interruption
+        self.hosts_up = checkpoint.live if checkpoint else HostBitmap(len(self.scope))
 
         if os.name == 'nt':
             socket_protocol = socket.IPPROTO_IP
@@ -93,58 +423,177 @@ class Scanner:
         if os.name == 'nt':
             self.socket.ioctl(socket.SIO_RCVALL, socket.RCVALL_ON)
 
+        self.ring = None
+        if ring_slots:
+            # give the kernel room to queue an unreachable storm between batches
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            except OSError:
+                pass
+            self.ring = PacketRing(self.socket, ring_slots, slot_size, batch, ring_drop)
+
+    # one recvfrom per packet, the original receive path
+    def _recvfrom_batches(self):
+        while True:
+            raw_buffer = self.socket.recvfrom(65535)[0]
+            yield [memoryview(raw_buffer)]
+
+    def receive(self):
+        if self.ring:
+            return self.ring.start().batches()
+        return self._recvfrom_batches()
+
+    def process(self, view):
+        # decode the IP header in place, no slicing
+        ip_header = IP(view)
+        offset = ip_header.ihl * 4
+        # if it's ICMP, we want it
+        if ip_header.protocol_num == 1:
+            icmp_header = ICMP(view, offset)
+            # check for TYPE 3 and CODE, then the cheap magic
+            # message test before touching any address objects
+            if icmp_header.code == 3 and icmp_header.type == 3:
+                if view[len(view) - len(self.message):] == self.message:
+                    host = self.scope.offset(ip_header.src_int)
+                    if host >= 0 and host != self.host_offset and self.hosts_up.add(host):
+                        self.sink.emit('host_up', host=str(ip_header.src_address))
+                        if self.checkpoint:
+                            self.checkpoint.dirty = True
+        elif not self.log_packets:
+            return
+        elif ip_header.protocol_num == 6:
+            tcp_header = TCP(view, offset)
+            self.sink.emit('tcp_packet', host=str(ip_header.src_address),
+                           src_port=tcp_header.src_port, dst_port=tcp_header.dst_port)
+        elif ip_header.protocol_num == 17:
+            udp_header = UDP(view, offset)
+            self.sink.emit('udp_packet', host=str(ip_header.src_address),
+                           src_port=udp_header.src_port, dst_port=udp_header.dst_port)
+
+    def save_checkpoint(self, force=False):
+        if self.sweeper:
+            self.checkpoint.advance(self.sweeper.settled())
+        if force:
+            self.checkpoint.save()
+        else:
+            self.checkpoint.maybe_save()
+
     def sniff(self):
-        hosts_up = set([f'{str(self.host)} *'])
         try:
-            while True:
-                # read a packet
-                raw_buffer = self.socket.recvfrom(65535)[0]
-
-                # create an IP header from the first 20 bytes
-                ip_header = IP(raw_buffer[0:20])
-                # if it's ICMP, we want it
-                if ip_header.protocol == "ICMP":
-                    offset = ip_header.ihl * 4
-                    buf = raw_buffer[offset:offset + 8]
-                    icmp_header = ICMP(buf)
-                    # check for TYPE 3 and CODE
-                    if icmp_header.code == 3 and icmp_header.type == 3:
-                        if ipaddress.ip_address(ip_header.src_address) in ipaddress.IPv4Network(SUBNET):
-                            # make sure it has our magic message
-                            if raw_buffer[len(raw_buffer) - len(MESSAGE):] == bytes(MESSAGE, 'utf8'):
-                                tgt = str(ip_header.src_address)
-                                if tgt != self.host and tgt not in hosts_up:
-                                    hosts_up.add(str(ip_header.src_address))
-                                    print(f'Host Up: {tgt}') 
-                elif ip_header.protocol == "TCP":
-                    buf = raw_buffer[offset:offset + 20]
-                    tcp_header = TCP(buf)
-                    print(f'TCP Packet -> Source Port: {tcp_header.src_port}, Destination Port: {tcp_header.dst_port}')
-                elif ip_header.protocol == "UDP":
-                    buf = raw_buffer[offset:offset + 8]
-                    udp_header = UDP(buf)
-                    print(f'UDP Packet -> Source Port: {udp_header.src_port}, Destination Port: {udp_header.dst_port}')
+            for batch in self.receive():
+                for view in batch:
+                    self.process(view)
+                self.sink.poll()
+                if self.checkpoint:
+                    self.save_checkpoint()
         
         # handle CTRL-C
         except KeyboardInterrupt: 
             if os.name == 'nt':
                 self.socket.ioctl(socket.SIO_RCVALL, socket.RCVALL_OFF)
 
+            self.sink.close()
             print('\nUser interrupted.')
-            if hosts_up:
-                print(f'\n\nSummary: Hosts up on {SUBNET}')
-            for host in sorted(hosts_up):
-                print(f'{host}')
+            if self.ring:
+                self.ring.stop()
+                print(f'Ring: {self.ring.received} packets received, full {self.ring.full} times, '
+                      f'{self.ring.dropped} dropped, {self.ring.truncated} truncated')
+            if self.checkpoint:
+                self.save_checkpoint(force=True)
+                print(f'Checkpoint saved to {self.checkpoint.path} at {self.checkpoint.cursor}/{len(self.scope)}')
+            print(f'\n\nSummary: Hosts up on {self.scope}')
+            print(f'{self.host} *')
+            for host in self.hosts_up:
+                print(ipaddress.IPv4Address(self.scope.address(host)))
             print('')
             sys.exit()
 
+# builds what a host answers to our probe: an ICMP port unreachable
+# quoting the original IP/UDP header and the magic message
+def sample_packet(src='192.168.1.23', dst='192.168.1.10'):
+    payload = bytes(MESSAGE, 'utf8')
+    udp = struct.pack('!HHHH', 53000, 65212, 8 + len(payload), 0)
+    inner = IP._header.pack(0x45, 0, 20 + len(udp) + len(payload), 1, 0, 64, 17, 0,
+                            socket.inet_aton(dst), socket.inet_aton(src))
+    icmp = ICMP._header.pack(3, 3, 0, 0, 0) + inner + udp + payload
+    outer = IP._header.pack(0x45, 0, 20 + len(icmp), 2, 0, 64, 1, 0,
+                            socket.inet_aton(src), socket.inet_aton(dst))
+    return outer + icmp
+
+# the decode path sniff used before the slotted headers, kept as a baseline
+def _legacy_decode(raw_buffer, message):
+    header = struct.unpack('<BBHHHBBH4s4s', raw_buffer[0:20])
+    src_address = ipaddress.ip_address(header[8])
+    ipaddress.ip_address(header[9])
+    protocol = {1: "ICMP", 6: "TCP", 17: "UDP"}[header[6]]
+    if protocol == "ICMP":
+        offset = (header[0] & 0xF) * 4
+        icmp = struct.unpack('<BBHHH', raw_buffer[offset:offset + 8])
+        if icmp[1] == 3 and icmp[0] == 3:
+            if ipaddress.ip_address(src_address) in ipaddress.IPv4Network(SUBNET):
+                return raw_buffer[len(raw_buffer) - len(message):] == message
+    return False
+
+def _slotted_decode(raw_buffer, message, scope):
+    view = memoryview(raw_buffer)
+    ip_header = IP(view)
+    if ip_header.protocol_num == 1:
+        icmp_header = ICMP(view, ip_header.ihl * 4)
+        if icmp_header.code == 3 and icmp_header.type == 3:
+            return raw_buffer.endswith(message) and scope.offset(ip_header.src_int) >= 0
+    return False
+
+def benchmark(count=200000):
+    packet = sample_packet()
+    message = bytes(MESSAGE, 'utf8')
+    scope = TargetScope()
+    for name, decode, args in (('legacy', _legacy_decode, (message,)),
+                               ('slotted', _slotted_decode, (message, scope))):
+        start = time.perf_counter()
+        for _ in range(count):
+            decode(packet, *args)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>8}: {count / elapsed:,.0f} packets/s')
+
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        host = sys.argv[1]
-    else:
-        host = '0.0.0.0'
-    s = Scanner(host)
+    parser = argparse.ArgumentParser(description='UDP host discovery scanner')
+    parser.add_argument('host', nargs='?', default='0.0.0.0', help='local address to sniff on')
+    parser.add_argument('-s', '--subnet', action='append', help='subnet to sweep, repeat or comma separate for several')
+    parser.add_argument('-x', '--exclude', action='append', default=[], help='subnet to leave out of the sweep')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='probes per second, 0 sends as fast as possible')
+    parser.add_argument('--send-batch', type=int, default=32, help='probes sent per token bucket draw')
+    parser.add_argument('--ring-slots', type=int, default=1024, help='receive slots in the packet ring, 0 reads one packet per recvfrom')
+    parser.add_argument('--slot-size', type=int, default=2048, help='bytes per receive slot')
+    parser.add_argument('--batch', type=int, default=64, help='max packets handed to the parser at once')
+    parser.add_argument('--ring-drop', action='store_true',
+                        help='discard packets while the ring is full instead of leaving them queued in the kernel')
+    parser.add_argument('--log-packets', action='store_true', help='also report every TCP/UDP packet seen')
+    scan_output.add_arguments(parser)
+    parser.add_argument('--checkpoint', metavar='FILE', help='save sweep progress to FILE')
+    parser.add_argument('--resume', action='store_true', help='continue the sweep saved in the checkpoint')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='time header decoding over N packets and exit')
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+        sys.exit()
+
+    subnets = [cidr for arg in args.subnet or [SUBNET] for cidr in arg.split(',')]
+    excludes = [cidr for arg in args.exclude for cidr in arg.split(',')]
+    scope = TargetScope(subnets, excludes)
+
+    checkpoint = None
+    if args.checkpoint:
+        import scan_state
+        checkpoint = scan_state.Checkpoint.open(args.checkpoint, f'scanner {scope}', len(scope), args.resume)
+
+    sweeper = UDPSweeper(scope, args.rate, args.send_batch, start=checkpoint.cursor if checkpoint else 0)
+    sink = scan_output.sinks_from_args('scanner', args)
+    s = Scanner(args.host, scope, args.ring_slots, args.slot_size, args.batch, sweeper, checkpoint,
+                sink, args.log_packets, args.ring_drop)
     time.sleep(5)
-    t = threading.Thread(target=udp_sender)
+    t = threading.Thread(target=sweeper.run, daemon=True)
     t.start()
-    s.sniff()
\ No newline at end of file
+    s.sniff()
@@ -1,29 +1,263 @@
-import subprocess
+import argparse
+import concurrent.futures
+import errno
+import select
 import socket
+import struct
+import subprocess
+import sys
+import time
+
+import connect_scan
+import scan_output
+import scan_state
 
-def ping_ip(ip):
-    response = subprocess.run(['ping', "-c", '1', ip])
+NETWORK = '10.10.30.0/24'
+ECHO_REQUEST = struct.Struct('!BBHHH')
+ECHO_PAYLOAD = b'PYTHONRULES!'
 
+# the original probe: one `ping` process per address, kept for comparison
+def subprocess_ping(ip, timeout=1):
+    response = subprocess.run(['ping', '-c', '1', '-W', str(max(1, int(timeout))), ip],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return response.returncode == 0
 
-def scan_network():
-    network_prefix = '10.10.30.'
-    
-    print("Scanning the network range...")
-
-    for i in range(0, 256):
-        ip = network_prefix + str(i)
-        if ping_ip(ip):
-            print(f"Active IP: {ip}")
-            port_scan(ip)
-
-def port_scan(ip):
-    ports = [21, 22, 23, 25, 80, 443, 8000, 8080]
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    for port in ports:
-        client.connect_ex((ip, port))
-        print(f'-> Port {port} open')
-    pass
+# unprivileged ICMP datagram sockets need the group to be in
+# net.ipv4.ping_group_range, check once whether we are allowed
+def icmp_available():
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+    except OSError:
+        return False
+    return True
+
+# echo over an ICMP datagram socket. the kernel fills in the id and the
+# checksum and only hands us replies to this socket, without the IP header
+def icmp_probe(ip, timeout):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP) as sock:
+            sock.settimeout(timeout)
+            sock.connect((ip, 0))
+            sock.send(ECHO_REQUEST.pack(8, 0, 0, 0, 1) + ECHO_PAYLOAD)
+            deadline = time.monotonic() + timeout
+            while True:
+                reply = sock.recv(512)
+                if reply and reply[0] == 0:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                sock.settimeout(remaining)
+    except OSError:
+        return False
+
+# without ICMP, connect to a few common ports at once: a handshake or a
+# reset from any of them means the host is there
+def tcp_probe(ip, timeout, ports=(80, 443, 22)):
+    socks = []
+    try:
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            socks.append(sock)
+            result = sock.connect_ex((ip, port))
+            if result in (0, errno.ECONNREFUSED):
+                return True
+        deadline = time.monotonic() + timeout
+        pending = list(socks)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _, writable, _ = select.select([], pending, [], remaining)
+            for sock in writable:
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) in (0, errno.ECONNREFUSED):
+                    return True
+                pending.remove(sock)
+        return False
+    finally:
+        for sock in socks:
+            sock.close()
+
+def check_port(ip, port, timeout):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        return client.connect_ex((ip, port)) == 0
+
+# like check_port, but an open port is fingerprinted over the same
+# connection; returns (open, service, banner)
+def probe_port(ip, port, timeout, banners=False):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        if client.connect_ex((ip, port)) != 0:
+            return False, None, None
+        if not banners:
+            return True, None, None
+        return (True,) + connect_scan.grab_banner_sync(client, port, timeout)
+
+# liveness probes and port checks share one bounded pool of worker
+# threads: a host that answers has its ports queued behind the remaining
+# probes instead of being scanned inline
+class ProbePool:
+    def __init__(self, workers=64, timeout=1.0, backend='auto', ports=connect_scan.PORTS, banners=False):
+        if backend == 'auto':
+            backend = 'icmp' if icmp_available() else 'tcp'
+        self.backend = backend
+        self.probe = icmp_probe if backend == 'icmp' else tcp_probe
+        self.timeout = timeout
+        self.ports = connect_scan.parse_ports(ports)
+        self.banners = banners
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def ping_ip(self, ip):
+        return self.executor.submit(self.probe, ip, self.timeout).result()
+
+    def port_scan(self, ip):
+        futures = [self.executor.submit(check_port, ip, port, self.timeout) for port in self.ports]
+        return [port for port, future in zip(self.ports, futures) if future.result()]
+
+    # yields ('up'|'down', ip, None, None) and ('open'|'closed', ip, port,
+    # (service, banner)) events as they complete
+    def scan(self, hosts):
+        pending = {}
+        for ip in hosts:
+            pending[self.executor.submit(self.probe, ip, self.timeout)] = (ip, None)
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                ip, port = pending.pop(future)
+                if port is None:
+                    if not future.result():
+                        yield 'down', ip, None, None
+                        continue
+                    yield 'up', ip, None, None
+                    for port in self.ports:
+                        future = self.executor.submit(probe_port, ip, port, self.timeout, self.banners)
+                        pending[future] = (ip, port)
+                else:
+                    is_open, service, banner = future.result()
+                    yield ('open' if is_open else 'closed'), ip, port, (service, banner)
+
+def network_hosts(network):
+    # accept the old "10.10.30." prefix form as well as a CIDR
+    if network.endswith('.'):
+        network += '0/24'
+    return connect_scan.parse_hosts(network)
+
+def ping_ip(ip, timeout=1.0):
+    if icmp_available():
+        return icmp_probe(ip, timeout)
+    return tcp_probe(ip, timeout)
+
+def port_scan(ip, ports=connect_scan.PORTS, timeout=1.0):
+    pool = ProbePool(timeout=timeout, ports=ports)
+    try:
+        return pool.port_scan(ip)
+    finally:
+        pool.close()
+
+def scan_network(network=NETWORK, workers=64, timeout=1.0, backend='auto', ports=connect_scan.PORTS,
+                 checkpoint_path=None, resume=False, sink=None, banners=False):
+    sink = sink or scan_output.open_sinks('scanner_ping')
+    pool = ProbePool(workers, timeout, backend, ports, banners)
+    hosts = network_hosts(network)
+    index = {ip: i for i, ip in enumerate(hosts)}
+    checkpoint = scan_state.Checkpoint(None, None, len(hosts))
+    if checkpoint_path:
+        key = f'scanner_ping {network} {",".join(map(str, pool.ports))}'
+        checkpoint = scan_state.Checkpoint.open(checkpoint_path, key, len(hosts), resume)
+
+    print(f"Scanning the network range {network} ({pool.backend} probes)...")
+
+    # finished hosts are reported from the checkpoint, anything cut off
+    # mid-scan is probed again from the start
+    todo = []
+    for i, ip in enumerate(hosts):
+        if i in checkpoint.done:
+            if i in checkpoint.live:
+                sink.emit('host_up', host=ip)
+                for port in checkpoint.ports.get(i, []):
+                    sink.emit('port_open', host=ip, port=port)
+        else:
+            checkpoint.ports.pop(i, None)
+            todo.append(ip)
+    remaining = {}
+
+    try:
+        for event, ip, port, info in pool.scan(todo):
+            i = index[ip]
+            if event == 'up':
+                sink.emit('host_up', host=ip)
+                checkpoint.mark_live(i)
+                remaining[ip] = len(pool.ports)
+            elif event == 'down':
+                checkpoint.mark_done(i)
+            else:
+                if event == 'open':
+                    sink.emit('port_open', host=ip, port=port, service=info[0], banner=info[1])
+                    checkpoint.add_port(i, port)
+                remaining[ip] -= 1
+            if remaining.get(ip) == 0:
+                checkpoint.mark_done(i)
+            if checkpoint.path:
+                checkpoint.maybe_save()
+            sink.poll()
+    finally:
+        pool.close()
+        sink.close()
+        if checkpoint.path:
+            checkpoint.advance(len(checkpoint.done))
+            checkpoint.save()
+
+# probes the same address `count` times through the subprocess path and
+# through the pool and reports probes per second for each
+def benchmark(count=50, ip='127.0.0.1', workers=64, backend='auto'):
+    start = time.perf_counter()
+    try:
+        for _ in range(count):
+            subprocess_ping(ip)
+    except FileNotFoundError:
+        print('[!] no ping binary, skipping the subprocess baseline')
+    else:
+        elapsed = time.perf_counter() - start
+        print(f'subprocess: {count / elapsed:,.0f} probes/s')
+
+    pool = ProbePool(workers, backend=backend)
+    try:
+        start = time.perf_counter()
+        futures = [pool.executor.submit(pool.probe, ip, pool.timeout) for _ in range(count)]
+        alive = sum(future.result() for future in futures)
+        elapsed = time.perf_counter() - start
+    finally:
+        pool.close()
+    print(f'{pool.backend + " pool":>10}: {count / elapsed:,.0f} probes/s ({alive}/{count} answered)')
 
 if __name__ == '__main__':
-    scan_network()
+    parser = argparse.ArgumentParser(description='ping sweep and port scan')
+    parser.add_argument('-n', '--network', default=NETWORK, help='CIDR or prefix like 10.10.30.')
+    parser.add_argument('-w', '--workers', type=int, default=64, help='probe threads')
+    parser.add_argument('--timeout', type=float, default=1.0, help='probe timeout in seconds')
+    parser.add_argument('--backend', choices=['auto', 'icmp', 'tcp'], default='auto', help='liveness probe')
+    parser.add_argument('-p', '--ports', default=','.join(map(str, connect_scan.PORTS)), help='ports to check on live hosts')
+    parser.add_argument('-b', '--banners', action='store_true', help='fingerprint open ports over the scan connection')
+    parser.add_argument('--checkpoint', metavar='FILE', help='save scan progress to FILE')
+    parser.add_argument('--resume', action='store_true', help='continue the scan saved in the checkpoint')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='compare N subprocess pings against the pool and exit')
+    scan_output.add_arguments(parser)
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+
+    if args.benchmark:
+        benchmark(args.benchmark, workers=args.workers, backend=args.backend)
+        sys.exit()
+
+    try:
+        scan_network(args.network, args.workers, args.timeout, args.backend, args.ports,
+                     args.checkpoint, args.resume, scan_output.sinks_from_args('scanner_ping', args), args.banners)
+    except KeyboardInterrupt:
+        print('User interrupted.')
+        sys.exit()
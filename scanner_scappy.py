@@ -1,42 +1,195 @@
-from scapy.all import IP, ICMP, sr1
+from scapy.all import ICMP, raw
+import argparse
+import asyncio
+import errno
+import os
 import socket
+import struct
+import threading
+import time
 
-def ping_ip(ip):
-    icmp = IP(dst=ip)/ICMP()
-    resp = sr1(icmp, timeout=1, verbose=0)  
-    return resp is not None 
-
-def port_scan(ip):
-    ports = [21, 22, 23, 25, 80, 443, 8000, 8080]
-    open_ports = []
-    
-    for port in ports:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)  
-
-        try:
-            result = sock.connect_ex((ip, port))
-            if result == 0: 
-                open_ports.append(port)
-        except socket.error:
-            pass
-        finally:
-            sock.close()
-    
-    return open_ports
-
-def scan_network():
-    network_prefix = '10.10.30.'
-
-    print("Scanning the network range 10.10.30.0 to 10.10.30.255...")
-
-    for i in range(0, 256):
-        ip = network_prefix + str(i)
-        if ping_ip(ip):
-            print(f"{ip} is up")
-            open_ports = port_scan(ip)
-            for port in open_ports:
-                print(f"-> Port {port} open")
+import connect_scan
+import scan_output
+import scan_state
+import scanner
+
+ECHO_PAYLOAD = b'PYTHONRULES!'
+# id and seq words of the ICMP header
+ID_SEQ = struct.Struct('!HH')
+
+# echo requests only differ in id/seq, so scapy crafts one template and
+# every other request is the template with id/seq patched in and the
+# checksum adjusted incrementally (RFC 1624)
+class EchoRequests:
+    def __init__(self, payload=ECHO_PAYLOAD):
+        self.template = bytearray(raw(ICMP(type=8, code=0, id=0, seq=0)/payload))
+        self.base = ~struct.unpack_from('!H', self.template, 2)[0] & 0xFFFF
+
+    def build(self, ident, seq):
+        total = self.base + ident + seq
+        total = (total & 0xFFFF) + (total >> 16)
+        total = (total & 0xFFFF) + (total >> 16)
+        packet = bytearray(self.template)
+        struct.pack_into('!H', packet, 2, ~total & 0xFFFF)
+        ID_SEQ.pack_into(packet, 4, ident, seq)
+        return bytes(packet)
+
+# pings every host through one raw ICMP socket. all requests are crafted
+# before the first one is sent; host i goes out with seq i & 0xFFFF and an
+# id that advances every 65536 hosts, so a single receiver thread can map
+# each echo reply straight back to its target. returns the set of hosts
+# that answered once `timeout` seconds have passed after the last request.
+# `rate` caps requests per second; unpaced, a request the kernel has no
+# room for is retried once after a short pause, and the ones that still
+# fail are counted and reported.
+def ping_sweep(hosts, timeout=1.0, rate=0):
+    if isinstance(hosts, str):
+        hosts = connect_scan.parse_hosts(hosts)
+    targets = [scanner.IPV4.unpack(socket.inet_aton(host))[0] for host in hosts]
+    base_ident = os.getpid() & 0xFFFF
+    echo = EchoRequests()
+    packets = [echo.build((base_ident + (i >> 16)) & 0xFFFF, i & 0xFFFF) for i in range(len(targets))]
+    live = scanner.HostBitmap(len(targets))
+    stop = threading.Event()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.settimeout(0.2)
+
+    def receive():
+        buffer = bytearray(2048)
+        view = memoryview(buffer)
+        while not stop.is_set():
+            try:
+                nbytes = sock.recv_into(buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if nbytes < 28:
+                continue
+            ip_header = scanner.IP(view)
+            icmp_header = scanner.ICMP(view, ip_header.ihl * 4)
+            if icmp_header.type != 0:
+                continue
+            index = (((icmp_header.id - base_ident) & 0xFFFF) << 16) | icmp_header.seq
+            if index < len(targets) and targets[index] == ip_header.src_int:
+                live.add(index)
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    try:
+        bucket = scanner.TokenBucket(rate) if rate else None
+        sendto = sock.sendto
+        failed = 0
+        for host, packet in zip(hosts, packets):
+            if bucket:
+                bucket.take()
+            try:
+                sendto(packet, (host, 0))
+            except OSError as e:
+                # the send queue is full: give it a moment and retry once
+                if not isinstance(e, socket.timeout) and e.errno != errno.ENOBUFS:
+                    failed += 1
+                    continue
+                time.sleep(0.001)
+                try:
+                    sendto(packet, (host, 0))
+                except OSError:
+                    failed += 1
+        if failed:
+            print(f"[!] {failed} of {len(hosts)} echo requests could not be sent, try a lower --rate")
+        time.sleep(timeout)
+    finally:
+        stop.set()
+        receiver.join()
+        sock.close()
+    return set(hosts[index] for index in live)
+
+def ping_ip(ip, timeout=1.0):
+    return ip in ping_sweep([ip], timeout)
+
+def port_scan(ip, ports=connect_scan.PORTS):
+    return connect_scan.scan_ports([ip], ports).get(ip, [])
+
+def scan_network(network='10.10.30.0/24', ports=connect_scan.PORTS, checkpoint_path=None, resume=False,
+                 sink=None, banners=False, rate=0):
+    sink = sink or scan_output.open_sinks('scanner_scappy')
+    hosts = connect_scan.parse_hosts(network)
+    ports = connect_scan.parse_ports(ports)
+    checkpoint = scan_state.Checkpoint(None, None, len(hosts))
+    if checkpoint_path:
+        key = f'scanner_scappy {network} {",".join(map(str, ports))}'
+        checkpoint = scan_state.Checkpoint.open(checkpoint_path, key, len(hosts), resume)
+
+    print(f"Scanning the network range {network}...")
+
+    def save(force=False):
+        if not checkpoint.path:
+            return
+        if force:
+            checkpoint.save()
+        else:
+            checkpoint.maybe_save()
+
+    # the cursor only moves past the sweep once all replies are in, so an
+    # interrupted sweep is simply run again
+    if checkpoint.cursor < len(hosts):
+        live = ping_sweep(hosts, rate=rate)
+        for index, ip in enumerate(hosts):
+            if ip in live:
+                checkpoint.mark_live(index)
+        checkpoint.advance(len(hosts))
+        save(force=True)
+
+    pending = {}
+    for index in checkpoint.live:
+        sink.emit('host_up', host=hosts[index])
+        if index in checkpoint.done:
+            for port in checkpoint.ports.get(index, []):
+                sink.emit('port_open', host=hosts[index], port=port)
+        else:
+            # a host cut off mid-scan is scanned again from its first port
+            checkpoint.ports.pop(index, None)
+            pending[hosts[index]] = index
+    remaining = dict.fromkeys(pending, len(ports))
+
+    # every live host is port scanned at once, results print as they land
+    async def stream():
+        async for result in connect_scan.scan(list(pending), ports, banners=banners):
+            index = pending[result.host]
+            if result.state == connect_scan.OPEN:
+                sink.emit('port_open', host=result.host, port=result.port,
+                          service=result.service, banner=result.banner)
+                checkpoint.add_port(index, result.port)
+            remaining[result.host] -= 1
+            if not remaining[result.host]:
+                checkpoint.mark_done(index)
+            save()
+            sink.poll()
+
+    sink.flush()
+    try:
+        if pending:
+            asyncio.run(stream())
+    except KeyboardInterrupt:
+        print('User interrupted.')
+    finally:
+        save(force=True)
+        sink.close()
 
 if __name__ == '__main__':
-    scan_network()
+    parser = argparse.ArgumentParser(description='ICMP sweep and TCP connect scan')
+    parser.add_argument('-n', '--network', default='10.10.30.0/24', help='hosts or CIDRs, comma separated')
+    parser.add_argument('-p', '--ports', default=','.join(map(str, connect_scan.PORTS)), help='ports to scan on live hosts')
+    parser.add_argument('-b', '--banners', action='store_true', help='fingerprint open ports over the scan connection')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='echo requests per second, 0 for unpaced')
+    parser.add_argument('--checkpoint', metavar='FILE', help='save scan progress to FILE')
+    parser.add_argument('--resume', action='store_true', help='continue the scan saved in the checkpoint')
+    scan_output.add_arguments(parser)
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+
+    scan_network(args.network, args.ports, args.checkpoint, args.resume,
+                 scan_output.sinks_from_args('scanner_scappy', args), banners=args.banners, rate=args.rate)
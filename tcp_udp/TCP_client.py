@@ -1,19 +1,39 @@
+import argparse
 import socket
 
+import loadtest
+
 target_host = "0.0.0.0"
 target_port = 9998
 
-#Create socket object
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def main():
+    parser = argparse.ArgumentParser(description='TCP client')
+    parser.add_argument('host', nargs='?', default=target_host)
+    parser.add_argument('port', nargs='?', type=int, default=target_port)
+    parser.add_argument('-m', '--message', default='ABCDEF',
+                        help='what to send; under --load a template with $conn, $seq, $rand and $time')
+    parser.add_argument('--load', action='store_true', help='load test the server instead of sending once')
+    loadtest.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.load:
+        loadtest.run(args, args.host, args.port, args.message)
+        return
+
+    #Create socket object
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    #Connect the client
+    client.connect((args.host, args.port))
 
-#Connect the client
-client.connect((target_host,target_port))
+    #send some data
+    client.send(args.message.encode())
 
-#send some data
-client.send(b"ABCDEF")
+    #receive data
+    response = client.recv(4096)
 
-#receive data
-response = client.recv(4096)
+    print(response)
+    client.close()
 
-print(response)
-client.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
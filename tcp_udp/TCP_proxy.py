@@ -1,74 +1,151 @@
-import sys
+import argparse
+import errno
+import multiprocessing
+import os
+import queue
+import resource
+import selectors
 import socket
+import sys
 import threading
+import time
+
+import pcap_writer
+import proxy_filters
+import proxy_stats
+import TCP_server
+import upstream_pool
+
+# stop reading from a side once this much is queued for the other side
+HIGH_WATER = 256 * 1024
+CHUNK = 64 * 1024
+
+# byte -> itself when it prints as a single character, '.' otherwise
+HEX_FILTER = bytes(i if len(repr(chr(i))) == 3 else ord('.') for i in range(256))
 
-HEX_FILTER = ''.join([(len(repr(chr(i))) == 3) and chr(i) or '.' for i in range(256)])
+# works on raw bytes (or any buffer) in bulk: one bytes.hex() and one
+# translate() for the whole dump, sliced into lines afterwards. max_bytes
+# bounds how much of the buffer is shown
+def hexdump(src, length=16, show=True, max_bytes=None):
+    if isinstance(src, str):
+        src = src.encode()
+    total = len(src)
+    data = bytes(src[:max_bytes] if max_bytes else src)
+    hexa = data.hex(' ').upper()
+    printable = data.translate(HEX_FILTER).decode('latin-1')
+    hexwidth = length*3
 
-def hexdump(src, length=16, show=True):
-    if isinstance(src, bytes):
-        src = src.decode()
-        
     results = list()
-    for i in range(0, len(src), length):
-        word = str(src[i:i+length])
-        printable = word.translate(HEX_FILTER)
-        hexa = ''.join([f'{ord(c):02X}' for c in word])
-        hexwidth = length*3
-        results.append(f'{i:04x} { hexa:<{hexwidth}} {printable}')
+    for i in range(0, len(data), length):
+        results.append(f'{i:04x} {hexa[i*3:(i+length)*3 - 1]:<{hexwidth}} {printable[i:i+length]}')
+    if len(data) < total:
+        results.append(f'.... {total - len(data)} more bytes')
 
     if show:
-        for line in results:
-            print(line)
+        print('\n'.join(results))
     else:
         return results
 
-def receive_from(connection):
-    buffer = b""
-    connection.settimeout(5)
+# hexdumps off the forwarding path: submit() copies at most max_bytes of
+# every `sample`-th buffer into a bounded queue and a logger thread does the
+# formatting and printing. when the queue is full the dump is dropped and
+# counted rather than making the proxy wait. line() queues a plain status
+# line the same way
+class DumpLog:
+    def __init__(self, max_bytes=None, sample=1, queue_size=256, stream=None):
+        self.max_bytes = max_bytes
+        self.sample = max(1, sample)
+        self.stream = stream or sys.stdout
+        self.queue = queue.Queue(queue_size)
+        self.seen = 0
+        self.dropped = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, label, data):
+        self.seen += 1
+        if self.seen % self.sample:
+            return
+        chunk = bytes(data[:self.max_bytes] if self.max_bytes else data)
+        try:
+            self.queue.put_nowait((label, chunk, len(data)))
+        except queue.Full:
+            self.dropped += 1
+
+    def line(self, text):
+        try:
+            self.queue.put_nowait((None, text, 0))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            label, chunk, total = self.queue.get()
+            if label is None:
+                self.stream.write(chunk + '\n')
+                self.stream.flush()
+                continue
+            lines = hexdump(chunk, show=False)
+            if len(chunk) < total:
+                lines.append(f'.... {total - len(chunk)} more bytes')
+            self.stream.write(f'[{label}] {total} bytes\n' + '\n'.join(lines) + '\n')
+            self.stream.flush()
+
+# yields data as it arrives, each chunk a view into one reusable buffer:
+# use or copy a chunk before asking for the next one. stops at end of
+# stream or after `timeout` seconds without data
+def receive_from(connection, buffer=None, timeout=5):
+    if buffer is None:
+        buffer = bytearray(CHUNK)
+    view = memoryview(buffer)
+    connection.settimeout(timeout)
     try:
         while True:
-            data = connection.recv(4096)
-            if not data: break
-            buffer += data
-    except Exception as e:
+            nbytes = connection.recv_into(buffer)
+            if not nbytes:
+                break
+            yield view[:nbytes]
+    except OSError:
         pass
-    return buffer
 
-        
 def request_handler(buffer):
-    # perform packet modifications
+    # buffer is one chunk as bytes (a view into the receive buffer while
+    # this stub only passes it through); perform packet modifications and
+    # return bytes
     return buffer
 
 def response_handler(buffer):
-    # perform packet modifications
+    # buffer is one chunk as bytes (a view into the receive buffer while
+    # this stub only passes it through); perform packet modifications and
+    # return bytes
     return buffer
 
+# passes each chunk through the handler and on to dst without building up
+# the whole exchange first; returns how many bytes came in
+def forward(chunks, handler, dst):
+    zero_copy = proxy_filters.passes_through(handler)
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        hexdump(chunk)
+        chunk = handler(chunk if zero_copy else bytes(chunk))
+        if len(chunk):
+            dst.sendall(chunk)
+    return total
+
 def proxy_handler(client_socket, remote_host, remote_port, receive_first):
     remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     remote_socket.connect((remote_host, remote_port))
-    
-    if receive_first:
-        remote_buffer = receive_from(remote_socket)
-        hexdump(remote_buffer)
+    local_buffer = bytearray(CHUNK)
+    remote_buffer = bytearray(CHUNK)
 
-        remote_buffer = response_handler(remote_buffer)
-        if len(remote_buffer):
-            client_socket.send(remote_buffer)
+    if receive_first:
+        forward(receive_from(remote_socket, remote_buffer), response_handler, client_socket)
 
     while True:
-        local_buffer = receive_from(client_socket)
-        if len(local_buffer):
-            hexdump(local_buffer)
-            local_buffer = request_handler(local_buffer)
-            remote_socket.send(local_buffer)
-        
-        remote_buffer = receive_from(remote_socket)
-        if len(remote_buffer):
-            hexdump(remote_buffer)
-            remote_buffer = response_handler(remote_buffer)
-            client_socket.send(remote_buffer)
-
-        if not len(local_buffer) or not len(remote_buffer):
+        local_count = forward(receive_from(client_socket, local_buffer), request_handler, remote_socket)
+        remote_count = forward(receive_from(remote_socket, remote_buffer), response_handler, client_socket)
+
+        if not local_count or not remote_count:
             client_socket.close()
             remote_socket.close()
             break
@@ -86,24 +163,734 @@ def server_loop(local_host, local_port, remote_host, remote_port, receive_first)
         proxy_thread = threading.Thread(target=proxy_handler, args=(client_socket, remote_host, remote_port, receive_first))
         proxy_thread.start()
 
+# one direction of a proxied session: bytes read from src, streamed
+# through the session's filter chain and sent to dst. only what dst could
+# not take right away is copied into `pending`; `offset` marks how much of
+# it is already sent. last_read orders the latest read against the other
+# direction's. bytes, chunks, first_at (first read), waits (times data had
+# to be queued) and queued_at (since when) feed the metrics
+class Pipe:
+    __slots__ = ('src', 'dst', 'filters', 'pending', 'offset', 'eof', 'shut', 'half_close', 'last_read', 'bytes',
+                 'chunks', 'first_at', 'waits', 'queued_at')
+
+    def __init__(self, src, dst, filters):
+        self.src = src
+        self.dst = dst
+        self.filters = filters
+        self.pending = bytearray()
+        self.offset = 0
+        self.eof = False
+        self.shut = False
+        self.half_close = True
+        self.last_read = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.first_at = 0.0
+        self.waits = 0
+        self.queued_at = 0.0
+
+    @property
+    def queued(self):
+        return len(self.pending) - self.offset
+
+class Session:
+    __slots__ = ('client', 'remote', 'upstream', 'downstream', 'connected', 'waiting', 'masks', 'peer', 'started',
+                 'connected_at')
+
+    def __init__(self, client, remote, peer, receive_first, requests, responses):
+        self.client = client
+        self.remote = remote
+        self.peer = peer
+        self.upstream = Pipe(client, remote, requests.session())
+        self.downstream = Pipe(remote, client, responses.session())
+        self.connected = False
+        # receive_first: hold the client until the remote has spoken
+        self.waiting = receive_first
+        self.masks = {}
+        self.started = time.monotonic()
+        self.connected_at = 0.0
+
+# single-threaded proxy: one selector watches the listener and both sockets
+# of every session, and each direction is forwarded as soon as its source
+# is readable. a side that cannot keep up stops being read once HIGH_WATER
+# bytes are queued for it, which pushes the backpressure back to the sender.
+# each direction runs through a proxy_filters.Pipeline, by default just the
+# request_handler/response_handler hooks. with pool_size, upstream
+# connections come from an upstream_pool.UpstreamPool kept warm in the
+# background. sessions are measured into a proxy_stats.Metrics unless
+# instrument is False, and `reporter`, if given, is called with the engine
+# about once a second
+class ProxyEngine:
+    def __init__(self, local_host, local_port, remote_host, remote_port, receive_first, dump=None, capture=None,
+                 requests=None, responses=None, pool_size=0, pool_idle=30.0, pool_reuse=False, reuse_port=False,
+                 reporter=None, instrument=True):
+        self.remote = (remote_host, remote_port)
+        self.receive_first = receive_first
+        self.dump = dump
+        # per-session status lines go through the dump queue too, so the
+        # loop never waits on the terminal
+        self.log = dump or DumpLog()
+        self.capture = capture
+        self.requests = requests or proxy_filters.Pipeline([proxy_filters.Hook(request_handler)])
+        self.responses = responses or proxy_filters.Pipeline([proxy_filters.Hook(response_handler)])
+        if capture:
+            # the pcap shows the upstream by address
+            self.remote_address = (socket.gethostbyname(remote_host), remote_port)
+        self.selector = selectors.DefaultSelector()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # several worker processes listen on the same port and the
+            # kernel spreads new connections across them
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind((local_host, local_port))
+        self.server.listen(1024)
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.sessions = set()
+        # counts reads, to tell which direction of a session spoke last
+        self.reads = 0
+        self.metrics = proxy_stats.Metrics() if instrument else None
+        self.reporter = reporter
+        self.pool = None
+        if pool_size:
+            self.pool = upstream_pool.UpstreamPool(self.selector, pool_size, pool_idle, reuse=pool_reuse)
+            self.pool.warm(self.remote)
+        # every read lands in this one buffer
+        self.buffer = bytearray(CHUNK)
+        self.view = memoryview(self.buffer)
+
+    def serve_forever(self):
+        host, port = self.server.getsockname()[:2]
+        print(f"Listening on {host}:{port}")
+        # the pool and the reporter need a look now and then even when
+        # nothing happens
+        timeout = 1.0 if self.pool or self.reporter else None
+        ticked = time.monotonic()
+        while True:
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.server:
+                    self._accept()
+                elif key.data is self.pool:
+                    self.pool.handle(key.fileobj)
+                else:
+                    session = key.data
+                    if session in self.sessions:
+                        self._handle(session, key.fileobj, events)
+            if timeout and time.monotonic() - ticked >= timeout:
+                if self.pool:
+                    self.pool.tick()
+                if self.reporter:
+                    self.reporter(self)
+                ticked = time.monotonic()
+
+    def _accept(self):
+        while True:
+            try:
+                client, addr = self.server.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                print(f"[!] accept failed: {e}")
+                return
+            self.log.line(f"Received incoming connection from {addr[0]}:{addr[1]}")
+            if self.metrics:
+                self.metrics.sessions += 1
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            remote = self.pool.checkout(self.remote) if self.pool else None
+            if remote is not None:
+                session = Session(client, remote, addr, self.receive_first, self.requests, self.responses)
+                self.sessions.add(session)
+                self._connected(session)
+                self._update(session)
+                continue
+            remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            remote.setblocking(False)
+            remote.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = Session(client, remote, addr, self.receive_first, self.requests, self.responses)
+            self.sessions.add(session)
+            result = remote.connect_ex(self.remote)
+            if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                print(f"[!] connect to {self.remote[0]}:{self.remote[1]} failed: {errno.errorcode.get(result, result)}")
+                self._close(session)
+                continue
+            self._update(session)
+
+    def _handle(self, session, sock, events):
+        try:
+            if sock is session.remote and not session.connected:
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise OSError(error, os.strerror(error))
+                if self.pool:
+                    self.pool.stats.record_connect(time.monotonic() - session.started)
+                self._connected(session)
+            if events & selectors.EVENT_WRITE:
+                pipe = session.downstream if sock is session.client else session.upstream
+                self._flush(pipe)
+            if events & selectors.EVENT_READ:
+                pipe = session.upstream if sock is session.client else session.downstream
+                self._read(session, pipe)
+        except Exception as e:
+            # a reset, or a handler hook that blew up: drop this session only
+            print(f"[!] {session.peer[0]}:{session.peer[1]} closed: {e}")
+            self._close(session)
+            return
+        if session.upstream.shut and (session.downstream.shut or self._reusable(session)):
+            self._close(session)
+        else:
+            self._update(session)
+
+    def _connected(self, session):
+        session.connected = True
+        session.connected_at = time.monotonic()
+        if self.metrics:
+            self.metrics.connect.record(session.connected_at - session.started)
+        if self.pool and self.pool.reuse:
+            # the upstream may serve another client, so the end of this one
+            # ends the session instead of being passed on
+            session.upstream.half_close = False
+        if self.capture:
+            self.capture.open(id(session), session.peer, self.remote_address)
+
+    # the client is done, everything it sent is out, the upstream has
+    # answered since the last request bytes and is still open and quiet: it
+    # can go back to the pool. until it has answered the session stays
+    # open, so a response still in flight reaches this client and not the
+    # next one
+    def _reusable(self, session):
+        down = session.downstream
+        return (self.pool is not None and self.pool.reuse and session.connected
+                and down.last_read > session.upstream.last_read and not down.eof and not down.queued)
+
+    def _read(self, session, pipe):
+        try:
+            nbytes = pipe.src.recv_into(self.buffer)
+        except BlockingIOError:
+            return
+        if pipe is session.downstream:
+            session.waiting = False
+        if not nbytes:
+            # whatever the filters still hold goes out ahead of the half-close
+            pipe.eof = True
+            chunk = pipe.filters.flush()
+        else:
+            self.reads += 1
+            pipe.last_read = self.reads
+            if self.metrics:
+                pipe.bytes += nbytes
+                pipe.chunks += 1
+                if pipe.chunks == 1:
+                    pipe.first_at = time.monotonic()
+            chunk = self.view[:nbytes]
+            if self.dump:
+                direction = '>' if pipe is session.upstream else '<'
+                self.dump.submit(f'{session.peer[0]}:{session.peer[1]} {direction}', chunk)
+            chunk = pipe.filters.feed(chunk)
+        if not len(chunk):
+            self._flush(pipe)
+            return
+        if self.capture:
+            self.capture.data(id(session), pipe is session.upstream, chunk)
+        # straight from the receive buffer to the other socket when nothing
+        # is queued ahead of it; only the part that did not fit is copied
+        sent = 0
+        if not pipe.queued:
+            try:
+                sent = pipe.dst.send(chunk)
+            except BlockingIOError:
+                pass
+        if sent < len(chunk):
+            if self.metrics:
+                pipe.waits += 1
+                if not pipe.queued:
+                    pipe.queued_at = time.monotonic()
+            pipe.pending += chunk[sent:]
+        self._flush(pipe)
+
+    def _flush(self, pipe):
+        if pipe.queued:
+            with memoryview(pipe.pending) as view, view[pipe.offset:] as tail:
+                try:
+                    sent = pipe.dst.send(tail)
+                except BlockingIOError:
+                    sent = 0
+            pipe.offset += sent
+            if pipe.offset == len(pipe.pending):
+                pipe.pending.clear()
+                pipe.offset = 0
+                # how long the receiver kept data waiting in the proxy
+                if pipe.queued_at:
+                    self.metrics.queue_delay.record(time.monotonic() - pipe.queued_at)
+                    pipe.queued_at = 0.0
+            elif pipe.offset >= HIGH_WATER:
+                del pipe.pending[:pipe.offset]
+                pipe.offset = 0
+        # once the source is done and everything is out, pass the
+        # half-close on so the other side sees end of stream
+        if pipe.eof and not pipe.queued and not pipe.shut:
+            pipe.shut = True
+            if pipe.half_close:
+                try:
+                    pipe.dst.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+
+    def _interest(self, session, sock):
+        if sock is session.remote and not session.connected:
+            return selectors.EVENT_WRITE
+        inbound = session.upstream if sock is session.client else session.downstream
+        outbound = session.downstream if sock is session.client else session.upstream
+        mask = 0
+        if not inbound.eof and inbound.queued < HIGH_WATER and session.connected:
+            if not (sock is session.client and session.waiting):
+                mask |= selectors.EVENT_READ
+        if outbound.queued:
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    def _update(self, session):
+        for sock in (session.client, session.remote):
+            mask = self._interest(session, sock)
+            current = session.masks.get(sock, 0)
+            if mask == current:
+                continue
+            if not current:
+                self.selector.register(sock, mask, session)
+            elif not mask:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, mask, session)
+            session.masks[sock] = mask
+
+    def _close(self, session):
+        self.sessions.discard(session)
+        if self.capture and session.connected:
+            self.capture.close(id(session))
+        if self.metrics:
+            self._account(session)
+        keep = session.upstream.shut and self._reusable(session)
+        for sock in (session.client, session.remote):
+            if session.masks.get(sock):
+                self.selector.unregister(sock)
+            if sock is session.remote and keep and self.pool.checkin(self.remote, sock):
+                continue
+            sock.close()
+        session.masks.clear()
+
+    def _account(self, session):
+        metrics = self.metrics
+        if not session.connected:
+            metrics.failed += 1
+            return
+        up, down = session.upstream, session.downstream
+        metrics.bytes_up += up.bytes
+        metrics.bytes_down += down.bytes
+        metrics.chunks_up += up.chunks
+        metrics.chunks_down += down.chunks
+        metrics.queued_up += up.waits
+        metrics.queued_down += down.waits
+        duration = time.monotonic() - session.started
+        metrics.duration.record(duration)
+        ttfb = ''
+        if down.first_at:
+            # from the first request byte, or from the connect when the
+            # upstream speaks first
+            start = up.first_at if 0 < up.first_at <= down.first_at else session.connected_at
+            metrics.ttfb.record(down.first_at - start)
+            ttfb = f', ttfb {(down.first_at - start) * 1000:.2f} ms'
+        self.log.line(f"[*] {session.peer[0]}:{session.peer[1]} done after {duration:.3f}s: "
+                      f"connect {(session.connected_at - session.started) * 1000:.2f} ms{ttfb}, "
+                      f"up {up.bytes} bytes/{up.chunks} chunks, down {down.bytes} bytes/{down.chunks} chunks")
+
+    # the metrics so far, with the sessions still open counted in
+    def stats(self):
+        current = proxy_stats.Metrics()
+        if self.metrics:
+            current.merge(self.metrics.snapshot())
+        for session in list(self.sessions):
+            current.active += 1
+            current.bytes_up += session.upstream.bytes
+            current.bytes_down += session.downstream.bytes
+            current.chunks_up += session.upstream.chunks
+            current.chunks_down += session.downstream.chunks
+        return current
+
+# upstream for the benchmark: swallows everything and reports the count
+def _discard(client, counts):
+    total = 0
+    buffer = bytearray(CHUNK)
+    with client:
+        while True:
+            nbytes = client.recv_into(buffer)
+            if not nbytes:
+                break
+            total += nbytes
+    counts.append(total)
+
+def _discard_server(server, connections, counts):
+    readers = []
+    for _ in range(connections):
+        client, _ = server.accept()
+        reader = threading.Thread(target=_discard, args=(client, counts))
+        reader.start()
+        readers.append(reader)
+    for reader in readers:
+        reader.join()
+
+def _push(port, payload, count, clients):
+    client = socket.create_connection(('127.0.0.1', port))
+    clients.append(client)
+    for _ in range(count):
+        client.sendall(payload)
+    client.shutdown(socket.SHUT_WR)
+
+def _run_engine(port, remote_port, quiet=True, pcap=None, replace=None, reuse_port=False, ready=None,
+                instrument=True):
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    capture = pcap_writer.PcapWriter(pcap) if pcap else None
+    requests = build_pipeline(request_handler, replace)
+    engine = ProxyEngine('127.0.0.1', port, '127.0.0.1', remote_port, False, capture=capture,
+                         requests=requests, reuse_port=reuse_port, instrument=instrument)
+    if ready is not None:
+        ready.put(os.getpid())
+    engine.serve_forever()
+
+# pushes `megabytes` over `streams` parallel connections through a loopback
+# proxy running in `workers` child processes and reports the throughput and
+# the largest child peak RSS, optionally with the traffic recorded to
+# `pcap`, rewritten by `replace` rules or not measured at all
+def benchmark(megabytes=300, block=1024 * 1024, pcap=None, replace=None, workers=1, streams=1, instrument=True):
+    upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    upstream.bind(('127.0.0.1', 0))
+    upstream.listen(1024)
+    counts = []
+    sink = threading.Thread(target=_discard_server, args=(upstream, streams, counts))
+    sink.start()
+
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    ready = multiprocessing.Queue()
+    proxies = [multiprocessing.Process(target=_run_engine,
+                                       args=(port, upstream.getsockname()[1], True, pcap, replace, workers > 1, ready,
+                                             instrument))
+               for _ in range(workers)]
+    for proxy in proxies:
+        proxy.start()
+    try:
+        # every worker has to be listening before the streams are spread
+        for _ in proxies:
+            ready.get(timeout=10)
+    except queue.Empty:
+        for proxy in proxies:
+            proxy.terminate()
+        raise RuntimeError('proxy did not come up')
+
+    payload = memoryview(bytearray(os.urandom(block)))
+    count = max(1, megabytes * 1024 * 1024 // block // streams)
+    clients = []
+    pushers = [threading.Thread(target=_push, args=(port, payload, count, clients)) for _ in range(streams)]
+    start = time.perf_counter()
+    for pusher in pushers:
+        pusher.start()
+    for pusher in pushers:
+        pusher.join()
+    sink.join()
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    for proxy in proxies:
+        proxy.terminate()
+        proxy.join()
+    upstream.close()
+
+    moved = sum(counts) / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    label = ''
+    if workers > 1 or streams > 1:
+        label = f'{workers} worker{"s" * (workers > 1)}, {streams} streams: '
+    print(f'[*] {label}{moved:.0f} MB in {elapsed:.2f}s: {moved / elapsed:,.0f} MB/s, proxy peak RSS {peak:.1f} MB')
+    return moved / elapsed
+
+def _exchange(port):
+    start = time.perf_counter()
+    with socket.create_connection(('127.0.0.1', port)) as client:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        greeting = client.recv(64)
+        client.sendall(b'ping')
+        echo = client.recv(64)
+    if greeting != b'HELLO\r\n' or echo != b'ping':
+        raise RuntimeError(f'unexpected reply {greeting!r} {echo!r}')
+    return time.perf_counter() - start
+
+# opens `sessions` short receive_first sessions one after another through a
+# proxy without and with an upstream pool and reports sessions per second,
+# latency and the pool's hit rate and connect times. the upstream greets
+# every connection after `delay` seconds, like a service with a costly
+# handshake, then echoes
+def churn_benchmark(sessions=500, delay=0.005, pool_size=16):
+    upstream_port = TCP_server.Server('127.0.0.1', 0, TCP_server.echo, greeting=b'HELLO\r\n', delay=delay).start()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        for size in (0, pool_size):
+            engine = ProxyEngine('127.0.0.1', 0, '127.0.0.1', upstream_port, True, pool_size=size)
+            threading.Thread(target=engine.serve_forever, daemon=True).start()
+            port = engine.server.getsockname()[1]
+            # let the pool fill before timing
+            time.sleep(delay * 2 + 0.1)
+            start = time.perf_counter()
+            latencies = sorted(_exchange(port) for _ in range(sessions))
+            elapsed = time.perf_counter() - start
+            label = f'pool of {size}' if size else 'no pool'
+            print(f'[*] {label}: {sessions / elapsed:,.0f} sessions/s, latency avg '
+                  f'{sum(latencies) / sessions * 1000:.2f} ms p99 {latencies[int(sessions * 0.99) - 1] * 1000:.2f} ms',
+                  file=stdout)
+            if engine.pool:
+                print(f'    {engine.pool.stats}', file=stdout)
+    finally:
+        # left open: the engines' logger threads may still be writing to it
+        sys.stdout = stdout
+
+# the hook plus, when there are any, the OLD -> NEW replacements
+def build_pipeline(handler, replace=None):
+    factories = [proxy_filters.Hook(handler)]
+    if replace:
+        factories.append(proxy_filters.Replace(replace))
+    return proxy_filters.Pipeline(factories)
+
+# the engine main() would run for these arguments; `index` numbers the
+# worker in --workers mode so each one records to its own pcap, and
+# `generation` counts its restarts so a replacement never truncates the
+# capture of the worker it replaces
+def engine_from_args(args, replace=None, replace_response=None, index=None, reporter=None, generation=0):
+    dump = None if args.no_dump else DumpLog(args.dump_bytes or None, args.dump_sample)
+    capture = None
+    if args.pcap:
+        path = args.pcap
+        if index is not None:
+            base, ext = os.path.splitext(path)
+            restart = f'-{generation}' if generation else ''
+            path = f'{base}.w{index}{restart}{ext or ".pcap"}'
+        capture = pcap_writer.PcapWriter(path, args.pcap_rotate * 1024 * 1024)
+    return ProxyEngine(args.local_host, args.local_port, args.remote_host, args.remote_port,
+                       "True" in args.receive_first, dump, capture, build_pipeline(request_handler, replace),
+                       build_pipeline(response_handler, replace_response), args.pool, args.pool_idle,
+                       args.pool_reuse, reuse_port=index is not None, reporter=reporter)
+
+def shutdown_engine(engine):
+    for label, pipeline in (('requests', engine.requests), ('responses', engine.responses)):
+        print(f"[*] {label} filters:")
+        print('\n'.join(f'    {line}' for line in pipeline.report()))
+    if engine.pool:
+        print(f"[*] {engine.pool.stats}")
+    if engine.metrics:
+        print_metrics(engine.stats())
+    if engine.capture:
+        engine.capture.stop()
+        if engine.capture.dropped:
+            print(f"[!] pcap writer fell behind, {engine.capture.dropped} payloads not recorded")
+
+def print_metrics(metrics):
+    print('\n'.join(f'[*] {line}' for line in metrics.lines()))
+
+# the engine's once-a-second hook: keeps the latest metrics for the
+# endpoint, prints them every `interval` seconds and, in a worker, passes
+# them up to the supervisor
+class Reporter:
+    def __init__(self, interval=0, metrics_port=None, stats=None, index=None):
+        self.interval = interval
+        self.stats = stats
+        self.index = index
+        self.latest = proxy_stats.Metrics()
+        self.printed = time.monotonic()
+        if metrics_port:
+            proxy_stats.MetricsServer(metrics_port, lambda: self.latest)
+
+    def __call__(self, engine):
+        self.latest = engine.stats()
+        if self.stats is not None:
+            self.stats.put((self.index, os.getpid(), self.latest.snapshot()))
+        if self.interval and time.monotonic() - self.printed >= self.interval:
+            print_metrics(self.latest)
+            self.printed = time.monotonic()
+
+def _worker(index, generation, args, replace, replace_response, stats):
+    reporter = Reporter(stats=stats, index=index)
+    engine = engine_from_args(args, replace, replace_response, index, reporter, generation)
+    try:
+        engine.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reporter(engine)
+        shutdown_engine(engine)
+
+# --workers mode: N processes, each with its own SO_REUSEPORT listener and
+# engine, so the kernel spreads clients over them and every core gets its
+# own interpreter. the parent restarts workers that die and adds up the
+# metrics they send about once a second, for the stats dump and the
+# metrics endpoint
+class Supervisor:
+    def __init__(self, args, workers, replace=None, replace_response=None):
+        self.args = args
+        self.replace = replace
+        self.replace_response = replace_response
+        self.interval = args.stats_interval or 10.0
+        self.stats = multiprocessing.Queue()
+        self.processes = [None] * workers
+        self.started = [0.0] * workers
+        self.generations = [0] * workers
+        # index -> metrics snapshot last heard from the current process,
+        # and what the processes it replaced had counted
+        self.latest = {}
+        self.retired = proxy_stats.Metrics()
+        self.restarts = 0
+        if args.metrics_port:
+            proxy_stats.MetricsServer(args.metrics_port, self.metrics)
+
+    def run(self):
+        for index in range(len(self.processes)):
+            self._start(index)
+        print(f"[*] {len(self.processes)} workers on {self.args.local_host}:{self.args.local_port}")
+        reported = time.monotonic()
+        try:
+            while True:
+                try:
+                    index, pid, snapshot = self.stats.get(timeout=1.0)
+                    if self.processes[index].pid == pid:
+                        self.latest[index] = snapshot
+                except queue.Empty:
+                    pass
+                self._check()
+                if time.monotonic() - reported >= self.interval:
+                    self.report()
+                    reported = time.monotonic()
+        except KeyboardInterrupt:
+            print("User interrupted.")
+        finally:
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join()
+            self.report()
+
+    def metrics(self):
+        total = proxy_stats.Metrics()
+        total.merge(self.retired.snapshot())
+        for snapshot in list(self.latest.values()):
+            total.merge(snapshot)
+        return total
+
+    def report(self):
+        print_metrics(self.metrics())
+        print(f"[*] {len(self.processes)} workers, {self.restarts} restarts")
+
+    def _start(self, index):
+        process = multiprocessing.Process(target=_worker, daemon=True,
+                                          args=(index, self.generations[index], self.args, self.replace,
+                                                self.replace_response, self.stats))
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+
+    def _check(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            print(f"[!] worker {index} (pid {process.pid}) exited with {process.exitcode}, restarting")
+            snapshot = self.latest.pop(index, None)
+            if snapshot:
+                snapshot['active'] = 0
+                self.retired.merge(snapshot)
+            self.restarts += 1
+            self.generations[index] += 1
+            # a worker that dies right away would otherwise be respawned
+            # in a tight loop
+            if time.monotonic() - self.started[index] < 1.0:
+                time.sleep(1.0)
+            self._start(index)
+
 def main():
-    if len(sys.argv[1:]) != 5:
-        print("Usage: ./proxy.py [localhost] [localport] [remotehost] [remoteport] [receive_first]")
-        print("Example: ./proxy.py 127.0.0.1 9000 10.12.132.1 9000 True")
-        sys.exit(0)
-
-    local_host = sys.argv[1]
-    local_port = int(sys.argv[2])
-    remote_host = sys.argv[3]
-    remote_port = int(sys.argv[4])
-    receive_first = sys.argv[5] 
-    
-    if "True" in receive_first:
-        receive_first = True
-    else:
-        receive_first = False
+    parser = argparse.ArgumentParser(description='TCP proxy',
+                                     epilog='Example: ./proxy.py 127.0.0.1 9000 10.12.132.1 9000 True')
+    parser.add_argument('local_host', nargs='?')
+    parser.add_argument('local_port', nargs='?', type=int)
+    parser.add_argument('remote_host', nargs='?')
+    parser.add_argument('remote_port', nargs='?', type=int)
+    parser.add_argument('receive_first', nargs='?', help='True to wait for the remote side to speak first')
+    parser.add_argument('--threaded', action='store_true', help='use the old thread-per-connection proxy')
+    parser.add_argument('--no-dump', action='store_true', help='do not hexdump the traffic')
+    parser.add_argument('--dump-bytes', type=int, default=0, help='hexdump at most this many bytes per buffer, 0 for all')
+    parser.add_argument('--dump-sample', type=int, default=1, help='hexdump only every Nth buffer')
+    parser.add_argument('--pcap', metavar='FILE', help='record both directions of every session to FILE')
+    parser.add_argument('--pcap-rotate', type=int, default=100, metavar='MB', help='start a new pcap file after MB megabytes')
+    parser.add_argument('--replace', action='append', default=[], metavar='OLD=NEW',
+                        help='rewrite OLD to NEW in client to server traffic (backslash escapes allowed, repeatable)')
+    parser.add_argument('--replace-response', action='append', default=[], metavar='OLD=NEW',
+                        help='rewrite OLD to NEW in server to client traffic')
+    parser.add_argument('--pool', type=int, default=0, metavar='N', help='keep N idle upstream connections ready')
+    parser.add_argument('--pool-idle', type=float, default=30.0, metavar='S', help='close pooled connections idle for S seconds')
+    parser.add_argument('--pool-reuse', action='store_true',
+                        help='return upstreams to the pool when their client closes (request/response protocols only)')
+    parser.add_argument('-w', '--workers', type=int, default=1, metavar='N',
+                        help='run N proxy processes sharing the port with SO_REUSEPORT')
+    parser.add_argument('--stats-interval', type=float, default=0, metavar='S',
+                        help='print session metrics every S seconds (every 10 with --workers)')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve the metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--churn-benchmark', type=int, metavar='N', help='run N short sessions without and with --pool and exit')
+    parser.add_argument('--benchmark', type=int, metavar='MB', help='push MB megabytes through a loopback proxy and exit')
+    args = parser.parse_args()
+    try:
+        replace = dict(map(proxy_filters.Replace.parse_rule, args.replace))
+        replace_response = dict(map(proxy_filters.Replace.parse_rule, args.replace_response))
+    except ValueError as e:
+        parser.error(str(e))
 
-    server_loop(local_host, local_port, remote_host, remote_port, receive_first)
+    if args.benchmark:
+        if args.workers > 1:
+            # the same parallel load through one worker and through N
+            single = benchmark(args.benchmark, pcap=args.pcap, replace=replace, streams=2 * args.workers)
+            scaled = benchmark(args.benchmark, pcap=args.pcap, replace=replace, workers=args.workers,
+                               streams=2 * args.workers)
+            print(f'[*] {scaled / single:.2f}x with {args.workers} workers on {os.cpu_count()} CPUs')
+        else:
+            # alternating runs, best of three each, so noise from the rest
+            # of the machine does not pass for the cost of the metrics
+            bare = measured = 0
+            for _ in range(3):
+                bare = max(bare, benchmark(args.benchmark, pcap=args.pcap, replace=replace, instrument=False))
+                measured = max(measured, benchmark(args.benchmark, pcap=args.pcap, replace=replace))
+            print(f'[*] best {bare:,.0f} MB/s without metrics, {measured:,.0f} MB/s with: '
+                  f'{(1 - measured / bare) * 100:.1f}% overhead')
+        return
+    if args.churn_benchmark:
+        churn_benchmark(args.churn_benchmark, pool_size=args.pool or 16)
+        return
+    if args.receive_first is None:
+        parser.error('local_host, local_port, remote_host, remote_port and receive_first are required')
+
+    if args.threaded:
+        if args.workers > 1:
+            parser.error('--workers needs the engine, not --threaded')
+        server_loop(args.local_host, args.local_port, args.remote_host, args.remote_port, "True" in args.receive_first)
+    elif args.workers > 1:
+        Supervisor(args, args.workers, replace, replace_response).run()
+    else:
+        reporter = None
+        if args.stats_interval or args.metrics_port:
+            reporter = Reporter(args.stats_interval, args.metrics_port)
+        engine = engine_from_args(args, replace, replace_response, reporter=reporter)
+        try:
+            engine.serve_forever()
+        except KeyboardInterrupt:
+            print("User interrupted.")
+        finally:
+            shutdown_engine(engine)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,25 +1,201 @@
+import argparse
+import asyncio
 import socket
+import struct
 import threading
 
 IP = "0.0.0.0"
 PORT = 9998
 
+LENGTH = struct.Struct('!I')
+MAX_FRAME = 16 * 1024 * 1024
+
+# what the server does with each message; returns the reply, or None
+def ack(message):
+    print(f'[*] Received: {message.decode("utf-8", errors="replace")}')
+    return b"ACK"
+
+def echo(message):
+    return message
+
+def discard(message):
+    return None
+
+HANDLERS = {'ack': ack, 'echo': echo, 'discard': discard}
+
+class ServerStats:
+    def __init__(self):
+        self.accepted = 0
+        self.active = 0
+        self.peak = 0
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def __str__(self):
+        return (f'{self.accepted} connections ({self.active} active, peak {self.peak}), '
+                f'{self.messages} messages, {self.bytes_in} bytes in, {self.bytes_out} out, '
+                f'{self.timeouts} timeouts, {self.errors} errors')
+
+# asyncio TCP server: every client is a coroutine instead of a thread, so a
+# burst of connections costs memory, not threads. at most max_connections
+# clients are served at once; while all slots are taken the server stops
+# accepting, so a burst waits in the kernel's listen queue (`backlog` deep)
+# instead of in the process. messages are read according to `mode`:
+#   stream  whatever one read returns, up to read_size bytes
+#   line    newline terminated, at most read_size bytes
+#   length  4-byte big-endian length prefix, at most MAX_FRAME bytes
+# a client that sends nothing for idle_timeout seconds is dropped, and once
+# the first byte of a message is in, the rest has read_timeout seconds. the
+# handler's reply (or awaited reply) goes back to the client. `greeting` is
+# sent on connect, after `delay` seconds, for services that speak first
+class Server:
+    def __init__(self, host=IP, port=PORT, handler=ack, mode='stream', max_connections=1000, backlog=1024,
+                 idle_timeout=60.0, read_timeout=10.0, read_size=65536, greeting=None, delay=0.0, verbose=False):
+        if mode not in ('stream', 'line', 'length'):
+            raise ValueError(f'unknown mode {mode!r}')
+        self.host = host
+        self.port = port
+        self.handler = handler
+        self.mode = mode
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.read_size = read_size
+        self.greeting = greeting
+        self.delay = delay
+        self.verbose = verbose
+        self.stats = ServerStats()
+        self.tasks = set()
+        self.ready = threading.Event()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((self.host, self.port))
+            server.listen(self.backlog)
+            server.setblocking(False)
+            self.port = server.getsockname()[1]
+            slots = asyncio.Semaphore(self.max_connections)
+            self.ready.set()
+            while True:
+                await slots.acquire()
+                try:
+                    client, _ = await loop.sock_accept(server)
+                except OSError as e:
+                    # out of file descriptors and the like: back off a bit
+                    print(f"[!] accept failed: {e}")
+                    slots.release()
+                    await asyncio.sleep(0.1)
+                    continue
+                task = loop.create_task(self._serve_client(client, slots))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def _serve_client(self, client, slots):
+        try:
+            reader, writer = await asyncio.open_connection(sock=client, limit=max(self.read_size, 2 ** 16))
+            await self.handle_client(reader, writer)
+        finally:
+            slots.release()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    # runs the server on its own event loop in a daemon thread, for tests
+    # and benchmarks that need a stub service; returns the bound port
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+        return self.port
+
+    async def handle_client(self, reader, writer):
+        stats = self.stats
+        stats.accepted += 1
+        if self.verbose:
+            address = writer.get_extra_info('peername')
+            print(f"[*] Accepted connection from {address[0]}:{address[1]}")
+        stats.active += 1
+        stats.peak = max(stats.peak, stats.active)
+        try:
+            if self.greeting:
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(self.greeting)
+                stats.bytes_out += len(self.greeting)
+            while True:
+                message = await self._read(reader)
+                if message is None:
+                    break
+                stats.messages += 1
+                stats.bytes_in += len(message)
+                reply = self.handler(message)
+                if asyncio.iscoroutine(reply):
+                    reply = await reply
+                if reply:
+                    stats.bytes_out += len(reply)
+                    if self.mode == 'length':
+                        # one write: a separate 4-byte header can sit out a
+                        # delayed ack before the body follows
+                        reply = LENGTH.pack(len(reply)) + reply
+                    writer.write(reply)
+                    await writer.drain()
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            stats.errors += 1
+        finally:
+            stats.active -= 1
+            writer.close()
+
+    # one message, or None at end of stream
+    async def _read(self, reader):
+        if self.mode == 'stream':
+            data = await asyncio.wait_for(reader.read(self.read_size), self.idle_timeout)
+            return data or None
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), self.idle_timeout)
+        except asyncio.IncompleteReadError:
+            return None
+        if self.mode == 'line':
+            if first == b'\n':
+                return first
+            rest = await asyncio.wait_for(reader.readuntil(b'\n'), self.read_timeout)
+            if len(rest) >= self.read_size:
+                raise ValueError('line too long')
+            return first + rest
+        header = first + await asyncio.wait_for(reader.readexactly(LENGTH.size - 1), self.read_timeout)
+        size, = LENGTH.unpack(header)
+        if size > MAX_FRAME:
+            raise ValueError(f'frame of {size} bytes')
+        return await asyncio.wait_for(reader.readexactly(size), self.read_timeout)
+
 def main():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((IP, PORT))
-    server.listen(5)
-    print(f"[*] Listening on {IP}:{PORT}")
-    while True:
-        client, address = server.accept()
-        print(f"[*] Accepted connection from {address[0]}:{address[1]}")
-        client_handler = threading.Thread(target=handle_client, args=(client,))
-        client_handler.start()
-
-def handle_client(client_socket):
-            with client_socket as sock:
-                request = sock.recv(1024)
-                print(f'[*] Received: {request.decode("utf-8")}')
-                sock.send(b"ACK")   
+    parser = argparse.ArgumentParser(description='asyncio TCP server')
+    parser.add_argument('--host', default=IP)
+    parser.add_argument('-p', '--port', type=int, default=PORT)
+    parser.add_argument('--handler', choices=sorted(HANDLERS), default='ack', help='what to do with each message')
+    parser.add_argument('--mode', choices=['stream', 'line', 'length'], default='stream', help='how messages are framed')
+    parser.add_argument('--max-connections', type=int, default=1000, help='clients served at once, more wait')
+    parser.add_argument('--backlog', type=int, default=1024, help='listen backlog, where clients wait for a slot')
+    parser.add_argument('--idle-timeout', type=float, default=60.0, help='drop clients silent for this many seconds')
+    parser.add_argument('--read-timeout', type=float, default=10.0, help='seconds to finish a started message')
+    parser.add_argument('--greeting', help='send this line to every client on connect')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not print every connection')
+    args = parser.parse_args()
+
+    greeting = args.greeting.encode() + b'\r\n' if args.greeting else None
+    server = Server(args.host, args.port, HANDLERS[args.handler], args.mode, args.max_connections, args.backlog,
+                    args.idle_timeout, args.read_timeout, greeting=greeting, verbose=not args.quiet)
+    print(f"[*] Listening on {args.host}:{args.port}")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        print(f"[*] {server.stats}")
 
 if __name__ == "__main__":
     main()
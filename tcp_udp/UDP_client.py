@@ -1,17 +1,36 @@
-
+import argparse
 import socket
 
+import loadtest
+
 target_host = "127.0.0.1"
 target_port = 9997
 
-#Create socket object
-client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def main():
+    parser = argparse.ArgumentParser(description='UDP client')
+    parser.add_argument('host', nargs='?', default=target_host)
+    parser.add_argument('port', nargs='?', type=int, default=target_port)
+    parser.add_argument('-m', '--message', default='AAABBBCCC',
+                        help='what to send; under --load a template with $conn, $seq, $rand and $time')
+    parser.add_argument('--load', action='store_true', help='load test the server instead of sending once')
+    loadtest.add_arguments(parser, udp=True)
+    args = parser.parse_args()
+
+    if args.load:
+        loadtest.run(args, args.host, args.port, args.message, udp=True)
+        return
+
+    #Create socket object
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    #send data
+    client.sendto(args.message.encode(), (args.host, args.port))
 
-#send data
-client.sendto(b"AAABBBCCC", (target_host,target_port))
+    #receive data
+    data, addr = client.recvfrom(4096)
 
-#receive data
-data, addr = client.recvfrom(4096)
+    print(data.decode())
+    client.close()
 
-print(data.decode)
-client.close
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import multiprocessing
+import random
+import string
+import threading
+import time
+
+import TCP_server
+from proxy_stats import Histogram
+
+# `attempts` counts what an error is out of: connections for TCP, requests
+# for UDP, where a stream does not fail as a whole
+class LoadStats:
+    def __init__(self, udp=False):
+        self.udp = udp
+        self.attempts = 0
+        self.connections = 0
+        self.requests = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.errors = collections.Counter()
+        self.connect = Histogram()
+        self.latency = Histogram()
+        self.elapsed = 0.0
+
+    def lines(self):
+        elapsed = self.elapsed or float('inf')
+        errors = sum(self.errors.values())
+        rate = errors / self.attempts * 100 if self.attempts else 0
+        megabytes = (self.bytes_out + self.bytes_in) / (1024 * 1024)
+        lines = [f'{self.requests} requests in {self.elapsed:.2f}s: {self.requests / elapsed:,.0f} requests/s, '
+                 f'{megabytes / elapsed:,.2f} MB/s, {errors} errors ({rate:.2f}% of {self.attempts} '
+                 f'{"requests" if self.udp else "connections"})']
+        if not self.udp:
+            lines.append(f'{self.connections} connections: {self.connections / elapsed:,.0f} connections/s')
+            lines.append(f'connect: {self.connect.summary()}')
+        lines.append(f'request: {self.latency.summary()}')
+        if errors:
+            lines.append('errors: ' + ', '.join(f'{name} {count}' for name, count in self.errors.most_common()))
+        return lines
+
+def frame(payload, mode):
+    if mode == 'line':
+        return payload if payload.endswith(b'\n') else payload + b'\n'
+    if mode == 'length':
+        return TCP_server.LENGTH.pack(len(payload)) + payload
+    return payload
+
+# what each request sends. $conn (the connection or stream number), $seq
+# (the request number), $rand (a random 32-bit number) and $time are filled
+# in per request; a payload without any `$` is framed once and reused
+class Payload:
+    def __init__(self, text, mode='stream'):
+        if isinstance(text, bytes):
+            text = text.decode()
+        self.mode = mode
+        self.template = string.Template(text)
+        self.static = None if '$' in text else frame(text.encode(), mode)
+
+    def render(self, conn, seq):
+        if self.static is not None:
+            return self.static
+        text = self.template.safe_substitute(conn=conn, seq=seq, rand=random.getrandbits(32),
+                                             time=f'{time.time():.6f}')
+        return frame(text.encode(), self.mode)
+
+async def read_reply(reader, mode, expect=0):
+    if mode == 'line':
+        return await reader.readuntil(b'\n')
+    if mode == 'length':
+        size, = TCP_server.LENGTH.unpack(await reader.readexactly(TCP_server.LENGTH.size))
+        return await reader.readexactly(size)
+    # a stream has no boundaries: read until `expect` bytes or the first read
+    data = await reader.read(65536)
+    while len(data) < expect:
+        more = await reader.read(65536)
+        if not more:
+            raise asyncio.IncompleteReadError(data, expect)
+        data += more
+    if not data:
+        raise asyncio.IncompleteReadError(data, expect)
+    return data
+
+# one client: connect, `requests` round trips, close. connect time and every
+# round trip go into the histograms, a failure is counted by exception name.
+# in stream mode the first read is the reply unless `expect` asks for that
+# many bytes
+async def one_connection(host, port, payload, index, requests, expect, timeout, greeting, stats, counter):
+    clock = time.perf_counter
+    mode = payload.mode
+    start = clock()
+    writer = None
+    stats.attempts += 1
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        stats.connect.record(clock() - start)
+        if greeting:
+            stats.bytes_in += len(await asyncio.wait_for(reader.readuntil(b'\n'), timeout))
+        for _ in range(requests):
+            data = payload.render(index, next(counter))
+            sent = clock()
+            writer.write(data)
+            reply = await asyncio.wait_for(read_reply(reader, mode, expect), timeout)
+            stats.latency.record(clock() - sent)
+            stats.requests += 1
+            stats.bytes_out += len(data)
+            stats.bytes_in += len(reply)
+        stats.connections += 1
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        stats.errors[type(e).__name__] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+# hands out job numbers to the workers: up to `total` (0 for no limit)
+# until `duration` seconds are up (0 for no limit), and with a rate, job n
+# is not started before n / rate seconds in
+class Schedule:
+    def __init__(self, total=0, duration=0.0, rate=0.0):
+        if not total and not duration:
+            raise ValueError('need a total or a duration')
+        self.total = total
+        self.rate = rate
+        self.started = time.perf_counter()
+        self.deadline = self.started + duration if duration else float('inf')
+        self.issued = 0
+
+    async def next(self):
+        if self.total and self.issued >= self.total:
+            return None
+        index = self.issued
+        self.issued += 1
+        if self.rate:
+            delay = self.started + index / self.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if time.perf_counter() >= self.deadline:
+            return None
+        return index
+
+# opens `total` connections (or as many as fit in `duration` seconds), at
+# most `concurrency` at a time and, with a rate, no more than `rate` new
+# ones per second
+async def tcp_load(host, port, total=1000, concurrency=100, payload=b'ping', mode='stream', requests=1, rate=0,
+                   timeout=5.0, expect=0, greeting=False, duration=0.0):
+    stats = LoadStats()
+    payload = Payload(payload, mode)
+    schedule = Schedule(total, duration, rate)
+    counter = itertools.count()
+
+    async def worker():
+        while True:
+            index = await schedule.next()
+            if index is None:
+                return
+            await one_connection(host, port, payload, index, requests, expect, timeout, greeting, stats, counter)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total or concurrency))))
+    stats.elapsed = time.perf_counter() - schedule.started
+    return stats
+
+class _Datagrams(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.waiter = None
+
+    def datagram_received(self, data, addr):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(data)
+
+    def error_received(self, exc):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(exc)
+
+# `concurrency` UDP streams, each a connected socket with one request in
+# flight, sharing `total` requests (or `duration` seconds) and `rate`
+# requests per second. a request without a reply in `timeout` seconds is
+# an error, and the stream moves to a new socket so a late reply cannot be
+# taken for the answer to the next request
+async def udp_load(host, port, total=1000, concurrency=10, payload=b'ping', rate=0, timeout=1.0, duration=0.0):
+    loop = asyncio.get_running_loop()
+    stats = LoadStats(udp=True)
+    payload = Payload(payload)
+    schedule = Schedule(total, duration, rate)
+    clock = time.perf_counter
+
+    async def stream(conn):
+        transport = None
+        try:
+            while True:
+                seq = await schedule.next()
+                if seq is None:
+                    return
+                if transport is None:
+                    transport, protocol = await loop.create_datagram_endpoint(_Datagrams, remote_addr=(host, port))
+                    stats.connections += 1
+                data = payload.render(conn, seq)
+                protocol.waiter = loop.create_future()
+                stats.attempts += 1
+                sent = clock()
+                try:
+                    transport.sendto(data)
+                    reply = await asyncio.wait_for(protocol.waiter, timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    stats.errors[type(e).__name__] += 1
+                    transport.close()
+                    transport = None
+                    continue
+                stats.latency.record(clock() - sent)
+                stats.requests += 1
+                stats.bytes_out += len(data)
+                stats.bytes_in += len(reply)
+        finally:
+            if transport is not None:
+                transport.close()
+
+    await asyncio.gather(*(stream(conn) for conn in range(min(concurrency, total or concurrency))))
+    stats.elapsed = clock() - schedule.started
+    return stats
+
+class _UDPEcho(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+async def _udp_echo(ready):
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(_UDPEcho,
+                                                                              local_addr=('127.0.0.1', 0))
+    ready.put(transport.get_extra_info('sockname')[1])
+    await asyncio.Event().wait()
+
+def _serve_local(mode, ready):
+    if mode == 'udp':
+        asyncio.run(_udp_echo(ready))
+        return
+    server = TCP_server.Server('127.0.0.1', 0, TCP_server.echo, mode, max_connections=100000)
+    ready.put(server.start())
+    threading.Event().wait()
+
+# an echo server (TCP_server's for the TCP modes, a datagram echo for
+# 'udp') in a child process, so the load generator gets the whole
+# interpreter to itself; returns (process, port)
+def local_server(mode='stream'):
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_local, args=(mode, ready), daemon=True)
+    process.start()
+    return process, ready.get(timeout=10)
+
+# the load test options, shared with TCP_client and UDP_client
+def add_arguments(parser, udp=False):
+    group = parser.add_argument_group('load test')
+    unit = 'requests' if udp else 'connections'
+    group.add_argument('-n', f'--{unit}', dest='total', type=int,
+                       help=f'{unit} in total (default: 1000, or no limit with --duration)')
+    group.add_argument('-d', '--duration', type=float, default=0.0, help='stop after this many seconds')
+    group.add_argument('-c', '--concurrency', type=int, default=10 if udp else 100,
+                       help=f'{"streams" if udp else "connections"} open at once')
+    group.add_argument('-r', '--rate', type=float, default=0, help=f'{unit} per second, 0 for as fast as possible')
+    group.add_argument('--timeout', type=float, default=1.0 if udp else 5.0, help='seconds to wait for a reply')
+    group.add_argument('--local', action='store_true', help='start a local echo server and load that')
+    if not udp:
+        group.add_argument('-k', '--requests', type=int, default=1, help='round trips per connection')
+        group.add_argument('--mode', choices=['stream', 'line', 'length'], default='stream', help='message framing')
+        group.add_argument('--expect', type=int, default=0,
+                           help='reply bytes to wait for in stream mode, 0 for whatever the first read returns')
+        group.add_argument('--greeting', action='store_true', help='the server sends a line first')
+
+# runs the load test described by add_arguments' options against
+# host:port, sending `payload` (a template), and prints the report
+def run(args, host, port, payload, udp=False):
+    total = args.total if args.total is not None else 0 if args.duration else 1000
+    if args.local:
+        _, port = local_server('udp' if udp else args.mode)
+        host = '127.0.0.1'
+    if udp:
+        load = udp_load(host, port, total, args.concurrency, payload, args.rate, args.timeout, args.duration)
+    else:
+        load = tcp_load(host, port, total, args.concurrency, payload, args.mode, args.requests, args.rate,
+                        args.timeout, args.expect, args.greeting, args.duration)
+    stats = asyncio.run(load)
+    print('\n'.join(f'[*] {line}' for line in stats.lines()))
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='TCP/UDP load generator')
+    parser.add_argument('host', nargs='?', default='127.0.0.1')
+    parser.add_argument('port', nargs='?', type=int, default=TCP_server.PORT)
+    parser.add_argument('--udp', action='store_true', help='send datagrams instead of opening connections')
+    parser.add_argument('--payload', default='ping', help='what to send each round trip, with $conn, $seq, $rand '
+                                                          'and $time filled in')
+    # the UDP options are a subset of the TCP ones
+    add_arguments(parser)
+    args = parser.parse_args()
+    run(args, args.host, args.port, args.payload, args.udp)
+
+if __name__ == '__main__':
+    main()
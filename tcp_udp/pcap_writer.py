@@ -0,0 +1,192 @@
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+
+PCAP_HEADER = struct.Struct('<IHHiIII')
+RECORD_HEADER = struct.Struct('<IIII')
+ETHERNET = struct.Struct('!6s6sH')
+IPV4 = struct.Struct('!BBHHHBBH4s4s')
+TCP = struct.Struct('!HHIIBBHHH')
+PSEUDO = struct.Struct('!4s4sBBH')
+
+LINKTYPE_ETHERNET = 1
+SNAPLEN = 65535
+# biggest payload whose whole frame, ethernet header included, still fits
+# the snaplen (and so also an IPv4 total length)
+MAX_SEGMENT = SNAPLEN - ETHERNET.size - IPV4.size - TCP.size
+
+FIN, SYN, PSH, ACK = 0x01, 0x02, 0x08, 0x10
+CLIENT_MAC = b'\x02\x00\x00\x00\x00\x01'
+SERVER_MAC = b'\x02\x00\x00\x00\x00\x02'
+
+# the ones' complement sum of 16-bit words is the value of the whole buffer
+# modulo 0xFFFF, which int.from_bytes lets us compute without a Python loop
+def checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = int.from_bytes(data, 'big') % 0xFFFF
+    if total == 0 and any(data):
+        total = 0xFFFF
+    return ~total & 0xFFFF
+
+# the synthesized TCP connection a proxied session is written as: real
+# client and upstream addresses, and sequence numbers that follow the bytes
+class Flow:
+    __slots__ = ('client', 'server', 'client_seq', 'server_seq', 'ip_id')
+
+    def __init__(self, client, server):
+        self.client = (socket.inet_aton(client[0]), client[1])
+        self.server = (socket.inet_aton(server[0]), server[1])
+        self.client_seq = random.getrandbits(32)
+        self.server_seq = random.getrandbits(32)
+        self.ip_id = 0
+
+# records proxied sessions to pcap files that Wireshark, scapy's rdpcap and
+# arp_poisoning/recapper.py can read. the proxy only queues events (a copy
+# of the payload and a timestamp); a writer thread synthesizes the
+# Ethernet/IPv4/TCP headers, writes through a large file buffer and rolls
+# over to a new file once the current one reaches `rotate_bytes`. if the
+# writer falls behind by more than `backlog` bytes, payloads are dropped and
+# counted instead of stalling the proxy. TCP checksums are left at zero
+# unless asked for, like a capture taken with checksum offload, since they
+# cost a pass over every payload and no dissector needs them
+class PcapWriter:
+    def __init__(self, path, rotate_bytes=100 * 1024 * 1024, backlog=64 * 1024 * 1024,
+                 tcp_checksums=False, buffer_size=1024 * 1024):
+        self.path = path
+        self.rotate_bytes = rotate_bytes
+        self.backlog = backlog
+        self.tcp_checksums = tcp_checksums
+        self.buffer_size = buffer_size
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.flows = {}
+        self.file = None
+        self.index = 0
+        self.written = 0
+        self.packets = 0
+        self.dropped = 0
+        self._open_file()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def open(self, key, client, server):
+        self.queue.put(('open', key, time.time(), (client, server)))
+
+    def data(self, key, from_client, payload):
+        size = len(payload)
+        with self.lock:
+            if self.queued + size > self.backlog:
+                self.dropped += 1
+                # keep the sequence numbers honest so the hole shows up
+                self.queue.put(('gap', key, time.time(), (from_client, size)))
+                return
+            self.queued += size
+        self.queue.put(('data', key, time.time(), (from_client, bytes(payload))))
+
+    def close(self, key):
+        self.queue.put(('close', key, time.time(), None))
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _file_name(self):
+        if not self.index:
+            return self.path
+        base, ext = os.path.splitext(self.path)
+        return f'{base}.{self.index}{ext or ".pcap"}'
+
+    def _open_file(self):
+        if self.file:
+            self.file.close()
+        self.file = open(self._file_name(), 'wb', buffering=self.buffer_size)
+        self.file.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, SNAPLEN, LINKTYPE_ETHERNET))
+        self.written = PCAP_HEADER.size
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            kind, key, stamp, args = event
+            if kind == 'open':
+                flow = self.flows[key] = Flow(*args)
+                # a handshake up front so dissectors see a complete stream
+                self._segment(stamp, flow, True, SYN, b'')
+                flow.client_seq += 1
+                self._segment(stamp, flow, False, SYN | ACK, b'')
+                flow.server_seq += 1
+                self._segment(stamp, flow, True, ACK, b'')
+            elif kind == 'data':
+                flow = self.flows.get(key)
+                if flow is None:
+                    continue
+                from_client, payload = args
+                with self.lock:
+                    self.queued -= len(payload)
+                view = memoryview(payload)
+                for offset in range(0, len(payload), MAX_SEGMENT):
+                    segment = view[offset:offset + MAX_SEGMENT]
+                    self._segment(stamp, flow, from_client, PSH | ACK, segment)
+                    if from_client:
+                        flow.client_seq = (flow.client_seq + len(segment)) & 0xFFFFFFFF
+                    else:
+                        flow.server_seq = (flow.server_seq + len(segment)) & 0xFFFFFFFF
+            elif kind == 'gap':
+                flow = self.flows.get(key)
+                if flow is None:
+                    continue
+                from_client, size = args
+                if from_client:
+                    flow.client_seq = (flow.client_seq + size) & 0xFFFFFFFF
+                else:
+                    flow.server_seq = (flow.server_seq + size) & 0xFFFFFFFF
+            elif kind == 'close':
+                flow = self.flows.pop(key, None)
+                if flow is None:
+                    continue
+                self._segment(stamp, flow, True, FIN | ACK, b'')
+                self._segment(stamp, flow, False, FIN | ACK, b'')
+            if self.queue.empty():
+                self.file.flush()
+        self.file.close()
+
+    def _segment(self, stamp, flow, from_client, flags, payload):
+        if from_client:
+            (src, sport), (dst, dport) = flow.client, flow.server
+            seq, ack = flow.client_seq, flow.server_seq
+            src_mac, dst_mac = CLIENT_MAC, SERVER_MAC
+        else:
+            (src, sport), (dst, dport) = flow.server, flow.client
+            seq, ack = flow.server_seq, flow.client_seq
+            src_mac, dst_mac = SERVER_MAC, CLIENT_MAC
+        if not flags & ACK:
+            ack = 0
+        flow.ip_id = (flow.ip_id + 1) & 0xFFFF
+
+        tcp = TCP.pack(sport, dport, seq, ack, 5 << 4, flags, 65535, 0, 0)
+        if self.tcp_checksums:
+            pseudo = PSEUDO.pack(src, dst, 0, socket.IPPROTO_TCP, len(tcp) + len(payload))
+            tcp = tcp[:16] + struct.pack('!H', checksum(pseudo + tcp + bytes(payload))) + tcp[18:]
+        total_len = IPV4.size + len(tcp) + len(payload)
+        ip = IPV4.pack(0x45, 0, total_len, flow.ip_id, 0x4000, 64, socket.IPPROTO_TCP, 0, src, dst)
+        ip = ip[:10] + struct.pack('!H', checksum(ip)) + ip[12:]
+
+        frame_len = ETHERNET.size + total_len
+        seconds = int(stamp)
+        self.file.write(RECORD_HEADER.pack(seconds, int((stamp - seconds) * 1000000), frame_len, frame_len))
+        self.file.write(ETHERNET.pack(dst_mac, src_mac, 0x0800))
+        self.file.write(ip)
+        self.file.write(tcp)
+        self.file.write(payload)
+        self.packets += 1
+        self.written += RECORD_HEADER.size + frame_len
+        if self.written >= self.rotate_bytes:
+            self.index += 1
+            self._open_file()
@@ -0,0 +1,253 @@
+import codecs
+import re
+import time
+
+# a filter sees one direction of one session as a stream: feed() gets each
+# chunk as it arrives and returns what to pass on (possibly nothing yet),
+# flush() is called once at end of stream for whatever is still held back.
+# filters are made per session, so they can keep state between chunks
+class Filter:
+    name = None
+
+    def feed(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+def _identity(buffer):
+    return buffer
+
+# True for a handler that is nothing but `return buffer`, like the
+# untouched request_handler/response_handler stubs
+def passes_through(handler):
+    code = getattr(handler, '__code__', None)
+    return (code is not None and code.co_argcount == 1 and code.co_code == _identity.__code__.co_code
+            and code.co_consts == _identity.__code__.co_consts)
+
+# wraps a request_handler/response_handler style function. it keeps no
+# state, so the one instance is handed to every session. the engine's
+# chunks are views into its receive buffer; a handler gets them as bytes,
+# unless it only passes them through, which then costs no copy
+class Hook(Filter):
+    def __init__(self, handler):
+        self.handler = handler
+        self.name = handler.__name__
+        self.zero_copy = passes_through(handler)
+
+    def __call__(self):
+        return self
+
+    def feed(self, data):
+        return self.handler(data if self.zero_copy else bytes(data))
+
+# a set of byte-string replacements. matches are leftmost first and, of
+# the patterns starting at the same place, the longest wins. a handful of
+# rules is searched with bytes.find, one pass per rule with its next hit
+# cached, which runs far faster than a regex alternation; bigger rule sets
+# are compiled into one alternation (longest first) so the cost does not
+# grow with the number of rules. calling it makes the per-session filter;
+# hit counts are kept here, per rule, across all sessions
+class Replace:
+    MAX_FIND_RULES = 8
+
+    def __init__(self, rules, name=None):
+        if not rules or not all(rules):
+            raise ValueError('replace rules need non-empty patterns')
+        self.rules = dict(rules)
+        self.name = name or 'replace(' + ','.join(repr(old)[2:-1] for old in self.rules) + ')'
+        self.ordered = sorted(self.rules, key=len, reverse=True)
+        self.pattern = None
+        if len(self.rules) > self.MAX_FIND_RULES:
+            self.pattern = re.compile(b'|'.join(map(re.escape, self.ordered)))
+        # a match can start up to this many bytes before the end of a chunk,
+        # and only where the rest of the chunk begins one of the patterns
+        self.keep = max(map(len, self.rules)) - 1
+        self.prefixes = {old[:size] for old in self.rules for size in range(1, len(old))}
+        self.firsts = {old[0] for old in self.rules}
+        self.hits = dict.fromkeys(self.rules, 0)
+        # time spent searching for each pattern. only the find path can
+        # tell them apart: the regex scans for all of them at once
+        self.seconds = dict.fromkeys(self.rules, 0.0)
+
+    def __call__(self):
+        return ReplaceFilter(self)
+
+    # yields (start, pattern) for the matches in buffer that start before
+    # `limit`
+    def matches(self, buffer, limit):
+        if limit <= 0:
+            return
+        if self.pattern is not None:
+            for match in self.pattern.finditer(buffer):
+                if match.start() >= limit:
+                    return
+                yield match.start(), match.group()
+            return
+        clock = time.perf_counter
+        seconds = self.seconds
+        found = {}
+        for old in self.ordered:
+            began = clock()
+            found[old] = buffer.find(old, 0, limit + len(old) - 1)
+            seconds[old] += clock() - began
+        pos = 0
+        while True:
+            best = -1
+            for old in self.ordered:
+                start = found[old]
+                if 0 <= start < pos:
+                    began = clock()
+                    start = found[old] = buffer.find(old, pos, limit + len(old) - 1)
+                    seconds[old] += clock() - began
+                if start >= 0 and (best < 0 or start < best):
+                    best, best_old = start, old
+            if best < 0:
+                return
+            yield best, best_old
+            pos = best + len(best_old)
+
+    # where the longest suffix of buffer[pos:] that a pattern could continue
+    # from starts, len(buffer) when there is none
+    def tail(self, buffer, pos=0):
+        size = len(buffer)
+        for start in range(max(pos, size - self.keep), size):
+            if buffer[start] in self.firsts and buffer[start:] in self.prefixes:
+                return start
+        return size
+
+    # parses OLD=NEW with backslash escapes, as given on the command line
+    @staticmethod
+    def parse_rule(text):
+        old, sep, new = text.partition('=')
+        if not sep or not old:
+            raise ValueError(f'expected OLD=NEW, got {text!r}')
+        return codecs.escape_decode(old.encode())[0], codecs.escape_decode(new.encode())[0]
+
+# the streaming side of Replace: only a chunk's tail that begins one of the
+# patterns is held back, in case the pattern continues into the next chunk,
+# so memory stays bounded no matter how long the stream is and a request
+# that cannot match is passed on whole
+class ReplaceFilter(Filter):
+    def __init__(self, rules):
+        self.rules = rules
+        self.name = rules.name
+        self.carry = b''
+        self.out = []
+
+    def feed(self, data):
+        buffer = self.carry + data
+        while True:
+            # every match starting before the cutoff is complete in the
+            # buffer: a longer one that ran past its end would start a
+            # longer tail
+            cutoff = self.rules.tail(buffer)
+            pos = self._rewrite(buffer, cutoff)
+            if pos <= cutoff:
+                break
+            # a match ran into the tail, look again at the few bytes after it
+            buffer = buffer[pos:]
+        self.out.append(buffer[pos:cutoff])
+        self.carry = buffer[cutoff:]
+        return self._take()
+
+    def flush(self):
+        buffer, self.carry = self.carry, b''
+        pos = self._rewrite(buffer, len(buffer))
+        self.out.append(buffer[pos:])
+        return self._take()
+
+    # queues the rewritten buffer up to the last match, returns where that
+    # match ended
+    def _rewrite(self, buffer, limit):
+        rules = self.rules
+        pos = 0
+        for start, old in rules.matches(buffer, limit):
+            self.out.append(buffer[pos:start])
+            self.out.append(rules.rules[old])
+            rules.hits[old] += 1
+            pos = start + len(old)
+        return pos
+
+    def _take(self):
+        data = b''.join(self.out)
+        self.out.clear()
+        return data
+
+class FilterStats:
+    __slots__ = ('name', 'calls', 'bytes_in', 'bytes_out', 'seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        rate = self.bytes_in / self.seconds / (1024 * 1024) if self.seconds else 0
+        per_call = self.seconds / self.calls * 1000000 if self.calls else 0
+        return (f'{self.name}: {self.calls} calls, {self.bytes_in} bytes in, {self.bytes_out} out, '
+                f'{self.seconds * 1000:.1f} ms ({per_call:.1f} us/call, {rate:,.0f} MB/s)')
+
+# the filters of one direction of one session, run in order. every call is
+# timed into the FilterStats shared by all sessions of the pipeline
+class FilterChain:
+    __slots__ = ('filters', 'stats')
+
+    def __init__(self, filters, stats):
+        self.filters = filters
+        self.stats = stats
+
+    def feed(self, data):
+        clock = time.perf_counter
+        for item, stats in zip(self.filters, self.stats):
+            if not len(data):
+                break
+            start = clock()
+            size = len(data)
+            data = item.feed(data)
+            stats.seconds += clock() - start
+            stats.calls += 1
+            stats.bytes_in += size
+            stats.bytes_out += len(data)
+        return data
+
+    # flushes each filter in turn, passing what it let go of through the
+    # filters after it
+    def flush(self):
+        clock = time.perf_counter
+        data = b''
+        for item, stats in zip(self.filters, self.stats):
+            start = clock()
+            size = len(data)
+            if size:
+                data = item.feed(data)
+            tail = item.flush()
+            if tail:
+                data = bytes(data) + tail
+            stats.seconds += clock() - start
+            stats.bytes_in += size
+            stats.bytes_out += len(data)
+        return data
+
+# a list of filter factories (called once per session) for one direction
+class Pipeline:
+    def __init__(self, factories):
+        self.factories = list(factories)
+        self.stats = [FilterStats(getattr(factory, 'name', None) or factory.__name__) for factory in self.factories]
+
+    def session(self):
+        return FilterChain([factory() for factory in self.factories], self.stats)
+
+    def report(self):
+        lines = [str(stats) for stats in self.stats]
+        for factory in self.factories:
+            if isinstance(factory, Replace):
+                if factory.pattern is None:
+                    lines.extend(f'  {old!r}: {count} hits, {factory.seconds[old] * 1000:.1f} ms searching'
+                                 for old, count in factory.hits.items())
+                else:
+                    lines.extend(f'  {old!r}: {count} hits' for old, count in factory.hits.items())
+                    lines.append(f'  (one regex for all {len(factory.rules)} rules, not timed per rule)')
+        return lines
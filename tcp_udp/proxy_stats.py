@@ -0,0 +1,148 @@
+import http.server
+import math
+import threading
+
+# log-linear buckets over microseconds in the style of HdrHistogram: values
+# below 32 us get a bucket each, above that every power of two is split
+# into 16 buckets, so any value is off by at most 1/16. recording is a
+# bit_length() and a list increment, and histograms from several workers
+# add up bucket by bucket
+class Histogram:
+    SUB_BUCKETS = 16
+    # top bucket starts at 2**31 us, about 36 minutes
+    MAX_SHIFT = 27
+
+    def __init__(self):
+        self.counts = [0] * (2 * self.SUB_BUCKETS + self.MAX_SHIFT * self.SUB_BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 32:
+            index = max(value, 0)
+        else:
+            shift = value.bit_length() - 5
+            index = min(32 + (shift - 1) * 16 + (value >> shift) - 16, len(self.counts) - 1)
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # upper edge of bucket `index`, in seconds
+    @staticmethod
+    def bucket_limit(index):
+        if index < 32:
+            return (index + 1) / 1000000
+        shift = (index - 32) // 16 + 1
+        top = (index - 32) % 16 + 16
+        return ((top + 1) << shift) / 1000000
+
+    def percentile(self, q):
+        if not self.total:
+            return 0.0
+        target = max(1, math.ceil(q * self.total))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_limit(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        return self.counts[:], self.total, self.sum, self.max
+
+    def merge(self, snapshot):
+        counts, total, seconds, peak = snapshot
+        for index, count in enumerate(counts):
+            if count:
+                self.counts[index] += count
+        self.total += total
+        self.sum += seconds
+        self.max = max(self.max, peak)
+
+    def summary(self):
+        if not self.total:
+            return 'no samples'
+        return (f'n={self.total} avg {self.sum / self.total * 1000:.3f} ms p50 {self.percentile(0.5) * 1000:.3f} '
+                f'p90 {self.percentile(0.9) * 1000:.3f} p99 {self.percentile(0.99) * 1000:.3f} '
+                f'max {self.max * 1000:.3f} ms')
+
+# what the proxy measures: session counters, bytes and chunks per
+# direction (up is client to upstream) and histograms of upstream connect
+# time, time to first byte from the upstream, how long data waited in the
+# proxy for a slow receiver, and session length
+class Metrics:
+    COUNTERS = ('sessions', 'failed', 'bytes_up', 'bytes_down', 'chunks_up', 'chunks_down', 'queued_up',
+                'queued_down')
+    HISTOGRAMS = ('connect', 'ttfb', 'queue_delay', 'duration')
+
+    def __init__(self):
+        self.active = 0
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        for name in self.HISTOGRAMS:
+            setattr(self, name, Histogram())
+
+    def snapshot(self):
+        return {
+            'active': self.active,
+            'counters': {name: getattr(self, name) for name in self.COUNTERS},
+            'histograms': {name: getattr(self, name).snapshot() for name in self.HISTOGRAMS},
+        }
+
+    def merge(self, snapshot):
+        self.active += snapshot['active']
+        for name, value in snapshot['counters'].items():
+            setattr(self, name, getattr(self, name) + value)
+        for name, histogram in snapshot['histograms'].items():
+            getattr(self, name).merge(histogram)
+
+    def lines(self):
+        lines = [f'{self.sessions} sessions ({self.active} active, {self.failed} failed), '
+                 f'up {self.bytes_up} bytes in {self.chunks_up} chunks ({self.queued_up} queued), '
+                 f'down {self.bytes_down} bytes in {self.chunks_down} chunks ({self.queued_down} queued)']
+        lines.extend(f'{name}: {getattr(self, name).summary()}' for name in self.HISTOGRAMS)
+        return lines
+
+    # Prometheus text format, histograms as summaries
+    def exposition(self, prefix='tcp_proxy'):
+        out = [f'{prefix}_active_sessions {self.active}']
+        for name in self.COUNTERS:
+            out.append(f'{prefix}_{name}_total {getattr(self, name)}')
+        for name in self.HISTOGRAMS:
+            histogram = getattr(self, name)
+            for q in (0.5, 0.9, 0.99, 0.999):
+                out.append(f'{prefix}_{name}_seconds{{quantile="{q}"}} {histogram.percentile(q):.6f}')
+            out.append(f'{prefix}_{name}_seconds_sum {histogram.sum:.6f}')
+            out.append(f'{prefix}_{name}_seconds_count {histogram.total}')
+        return '\n'.join(out) + '\n'
+
+# serves source() (a Metrics) as text on http://host:port/metrics from a
+# daemon thread
+class MetricsServer:
+    def __init__(self, port, source, host='127.0.0.1'):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = source().exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
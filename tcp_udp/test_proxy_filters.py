@@ -0,0 +1,39 @@
+import socket
+import threading
+import unittest
+
+import TCP_proxy
+import TCP_server
+import proxy_filters
+
+# a Replace filter must pass on a request that cannot match whole, or an
+# interactive exchange stalls until the client half-closes
+class ReplaceExchangeTest(unittest.TestCase):
+    def test_chunk_without_pattern_prefix_is_not_held(self):
+        replace = proxy_filters.Replace({b'secret-token': b'REDACTED'})()
+        self.assertEqual(replace.feed(b'GET / HTTP/1.0\r\n\r\n'), b'GET / HTTP/1.0\r\n\r\n')
+        self.assertEqual(replace.feed(b'auth secret-'), b'auth ')
+        self.assertEqual(replace.feed(b'token\r\n'), b'REDACTED\r\n')
+        self.assertEqual(replace.flush(), b'')
+
+    def test_request_response_through_engine(self):
+        upstream = TCP_server.Server('127.0.0.1', 0, TCP_server.echo).start()
+        requests = TCP_proxy.build_pipeline(TCP_proxy.request_handler, {b'secret-token': b'REDACTED'})
+        engine = TCP_proxy.ProxyEngine('127.0.0.1', 0, '127.0.0.1', upstream, False, requests=requests)
+        threading.Thread(target=engine.serve_forever, daemon=True).start()
+        with socket.create_connection(engine.server.getsockname()) as client:
+            client.settimeout(5)
+            for request, reply in ((b'GET / HTTP/1.0\r\n\r\n', b'GET / HTTP/1.0\r\n\r\n'),
+                                   (b'token: secret-token\r\n', b'token: REDACTED\r\n')):
+                # no half-close: the reply has to come back while the
+                # connection is still open both ways
+                client.sendall(request)
+                received = b''
+                while len(received) < len(reply):
+                    data = client.recv(4096)
+                    self.assertTrue(data, 'connection closed early')
+                    received += data
+                self.assertEqual(received, reply)
+
+if __name__ == '__main__':
+    unittest.main()
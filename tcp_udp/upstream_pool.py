@@ -0,0 +1,168 @@
+import collections
+import errno
+import selectors
+import socket
+import time
+
+class PoolStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        self.connects = 0
+        self.connect_time = 0.0
+        self.connect_max = 0.0
+        self.failed = 0
+        self.stale = 0
+        self.expired = 0
+
+    def record_connect(self, seconds):
+        self.connects += 1
+        self.connect_time += seconds
+        self.connect_max = max(self.connect_max, seconds)
+
+    def __str__(self):
+        checkouts = self.hits + self.misses
+        rate = self.hits / checkouts * 100 if checkouts else 0
+        mean = self.connect_time / self.connects * 1000 if self.connects else 0
+        return (f'pool: {rate:.1f}% hit rate ({self.hits} hits, {self.reused} reused, {self.misses} misses), '
+                f'{self.connects} connects avg {mean:.2f} ms max {self.connect_max * 1000:.2f} ms, '
+                f'{self.failed} failed, {self.stale} stale, {self.expired} expired')
+
+# keeps up to `size` idle, already connected upstream sockets per target so
+# a new client does not wait for the handshake. connects are non-blocking
+# and finish on the proxy's own selector, which calls handle() for sockets
+# registered with the pool as their data. an idle socket is health checked
+# (a MSG_PEEK that must not see end of stream or an error) before it is
+# handed out, and closed after `idle_timeout` seconds. for receive_first
+# services the greeting is already waiting in a warm socket. with
+# reuse=True, an upstream whose client went away cleanly goes back into
+# the pool, ahead of the fresh ones and up to `limit` idle sockets per
+# target; only safe for protocols where each request gets its full answer
+# before the client closes
+class UpstreamPool:
+    def __init__(self, selector, size=8, idle_timeout=30.0, connect_timeout=5.0, reuse=False, limit=None):
+        self.selector = selector
+        self.size = size
+        self.limit = limit or 2 * size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.reuse = reuse
+        # target -> deque of (sock, idle since, was used before)
+        self.idle = {}
+        # sock -> (target, connect started)
+        self.connecting = {}
+        self.stats = PoolStats()
+
+    def warm(self, target):
+        self.idle.setdefault(target, collections.deque())
+        self._refill(target)
+
+    def checkout(self, target):
+        idle = self.idle.get(target)
+        # oldest fresh socket first: it has had the longest to receive a
+        # greeting
+        while idle:
+            sock, _, used = idle.popleft()
+            if self._healthy(sock, used):
+                self.stats.hits += 1
+                if used:
+                    self.stats.reused += 1
+                self._refill(target)
+                return sock
+            self.stats.stale += 1
+            sock.close()
+        self.stats.misses += 1
+        if idle is not None:
+            self._refill(target)
+        return None
+
+    # takes back the upstream of a finished session; False if the caller
+    # should close it instead
+    def checkin(self, target, sock):
+        idle = self.idle.get(target)
+        if not self.reuse or idle is None or len(idle) >= self.limit or not self._healthy(sock, True):
+            return False
+        idle.appendleft((sock, time.monotonic(), True))
+        return True
+
+    def handle(self, sock):
+        target, started = self.connecting.pop(sock)
+        self.selector.unregister(sock)
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.stats.failed += 1
+            sock.close()
+            return
+        self.stats.record_connect(time.monotonic() - started)
+        self.idle[target].append((sock, time.monotonic(), False))
+
+    # expires and re-checks idle sockets, gives up on slow connects and
+    # tops every target back up
+    def tick(self):
+        now = time.monotonic()
+        for sock, (target, started) in list(self.connecting.items()):
+            if now - started > self.connect_timeout:
+                del self.connecting[sock]
+                self.selector.unregister(sock)
+                sock.close()
+                self.stats.failed += 1
+        for target, idle in self.idle.items():
+            keep = collections.deque()
+            for sock, since, used in idle:
+                if now - since > self.idle_timeout:
+                    self.stats.expired += 1
+                    sock.close()
+                elif not self._healthy(sock, used):
+                    self.stats.stale += 1
+                    sock.close()
+                else:
+                    keep.append((sock, since, used))
+            self.idle[target] = keep
+            self._refill(target)
+
+    def close(self):
+        for sock in self.connecting:
+            self.selector.unregister(sock)
+            sock.close()
+        self.connecting.clear()
+        for idle in self.idle.values():
+            for sock, _, _ in idle:
+                sock.close()
+            idle.clear()
+
+    def _refill(self, target):
+        pending = sum(1 for waiting, _ in self.connecting.values() if waiting == target)
+        for _ in range(self.size - len(self.idle[target]) - pending):
+            if not self._connect(target):
+                break
+
+    def _connect(self, target):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        started = time.monotonic()
+        result = sock.connect_ex(target)
+        if result == 0:
+            self.stats.record_connect(time.monotonic() - started)
+            self.idle[target].append((sock, time.monotonic(), False))
+        elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.connecting[sock] = (target, started)
+            self.selector.register(sock, selectors.EVENT_WRITE, self)
+        else:
+            self.stats.failed += 1
+            sock.close()
+            return False
+        return True
+
+    # alive means no error and no end of stream. a fresh socket may already
+    # hold the server's greeting, a reused one must not hold anything
+    @staticmethod
+    def _healthy(sock, used):
+        try:
+            data = sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return bool(data) and not used